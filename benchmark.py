@@ -0,0 +1,602 @@
+#!/usr/bin/env python
+
+# Author:       Tyson Jones, January 2016 (MURPA student of Prof Frank Wuerthwein, UCSD).
+#               Feel free to contact me at  tjon14@student.monash.edu
+
+# Purpose:      times alternative paths through the condorflux daemon against synthetic jobs, checking they agree.
+#               Run (beside daemon.py, where the condor bindings are importable) as
+#                   python benchmark.py [num jobs] [num bins]
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import tempfile
+import urllib2
+import inspect
+import random
+import shutil
+import time
+import sys
+import os
+
+import daemon
+
+daemon.DEBUG_PRINT = False
+
+
+BIN_DURATION = 5*60
+DEFAULT_NUM_JOBS = 20000
+DEFAULT_NUM_BINS = 288
+
+# lines per request, as the outbox once fragmented its writes
+LINES_PER_FRAGMENT = 300
+
+# seconds the stand-in influx takes to respond to a write when imitating a distant server
+STAND_IN_INFLUX_LATENCY = 0.02
+
+
+class StandInConfig(object):
+    """the only config settings consulted by the benchmarked job methods"""
+    node_renames = {}
+
+
+class StandInCache(object):
+    """a job cache which knows only that every job's cached fields were 0 when it started running"""
+
+    @staticmethod
+    def get_prev_running_value_state_and_time(job, field):
+        return 0, daemon.Job.Status.RUNNING, job.last_run_start_time or False
+
+
+def make_jobs(num_jobs, bin_times, seed=0):
+    """returns num_jobs Jobs which idle, run and complete at random times over the bins"""
+    rnd = random.Random(seed)
+    start, end = bin_times[0], bin_times[-1] + BIN_DURATION
+    jobs = []
+    for i in range(num_jobs):
+        queue_time = rnd.randint(start - 3600, end - 60)
+        ad = {daemon.Ad.id: "benchmark#%s" % i,
+              daemon.Ad.queue_time: queue_time,
+              daemon.Ad.server_time: end,
+              daemon.Ad.submit_site: "SITE%s" % rnd.randint(0, 4),
+              daemon.Ad.job_site: "SITE%s" % rnd.randint(0, 9),
+              "Owner": "user%s" % rnd.randint(0, 49),
+              daemon.Ad.remote_user_cpu_duration: rnd.randint(0, 36000),
+              daemon.Ad.remote_sys_cpu_duration: rnd.randint(0, 3600)}
+        kind = rnd.randint(0, 2)
+        if kind == 0:
+            ad.update({daemon.Ad.status: 1, daemon.Ad.entered_status_time: queue_time})
+        else:
+            run_start = rnd.randint(queue_time + 1, end - 30)
+            ad.update({daemon.Ad.status: 2, daemon.Ad.prev_status: 1,
+                       daemon.Ad.last_remote_host: "slot1@" + ad[daemon.Ad.job_site],
+                       daemon.Ad.last_run_start_time: run_start, daemon.Ad.entered_status_time: run_start})
+            if kind == 2:
+                run_end = rnd.randint(run_start + 1, end - 1)
+                ad.update({daemon.Ad.status: 4, daemon.Ad.prev_status: 2,
+                           daemon.Ad.entered_status_time: run_end, daemon.Ad.completion_date: run_end})
+        jobs.append(daemon.Job(ad, StandInCache(), StandInConfig()))
+    return daemon.JobList(jobs)
+
+
+def time_call(func, *args):
+    """returns (seconds taken, result) of calling func with args"""
+    t0 = time.time()
+    result = func(*args)
+    return time.time() - t0, result
+
+
+def normalise(all_results):
+    """returns the results at each bin in a comparable order"""
+    return [sorted((val, sorted(tags.items())) for val, tags in results) for results in all_results]
+
+
+def get_default_metrics():
+    """returns the metric classes of the default metrics.py"""
+    namespace = {}
+    exec daemon.MetricManager.DEFAULT_METRICS in namespace
+    metric_classes = [obj for obj in namespace.values() if inspect.isclass(obj)]
+    for metric_class in metric_classes:
+        daemon.MetricKind.prepare(metric_class)
+    return metric_classes
+
+
+# calculate_at_bin forms of the default metrics' kinds
+def count_idle_jobs_at_bin(self, time_bin, jobs):
+    for job in jobs:
+        if job.is_idle_during(time_bin.start_time, time_bin.end_time):
+            time_bin.add_to_sum(1, job.get_values(self.tags))
+    return time_bin.get_sum()
+
+def count_running_jobs_at_bin(self, time_bin, jobs):
+    for job in jobs:
+        if job.is_running_during(time_bin.start_time, time_bin.end_time):
+            time_bin.add_to_sum(1, job.get_values(self.tags))
+    return time_bin.get_sum()
+
+AT_BIN_FORMS = {"count_idle": (count_idle_jobs_at_bin, "idle"),
+                "count_running": (count_running_jobs_at_bin, "running")}
+
+
+def run_at_bin(metric_inst, calculate_at_bin, span, jobs, bin_times):
+    """evaluates the metric bin by bin, giving each bin only the jobs in the span (as process_metrics does)"""
+    jobs_by_bin = daemon.BinIndex(bin_times, BIN_DURATION).iter_jobs_by_bin(jobs, daemon.MetricManager.SPANS[span])
+    return [calculate_at_bin(metric_inst, daemon.Bin(t, t + BIN_DURATION), daemon.JobList(bin_jobs))
+            for t, bin_jobs in zip(bin_times, jobs_by_bin)]
+
+
+def run_over_bins(metric_inst, jobs, bin_times):
+    """evaluates the metric at every bin at once"""
+    return metric_inst.calculate_over_bins([daemon.Bin(t, t + BIN_DURATION) for t in bin_times], jobs)
+
+
+def benchmark_metric_paths(jobs, bin_times):
+    """compares each default metric's kind (so calculate_over_bins) against its calculate_at_bin form"""
+    print "calculate_at_bin (with span) vs calculate_over_bins (of kind):"
+    for metric_class in get_default_metrics():
+        metric_inst = metric_class()
+        calculate_at_bin, span = AT_BIN_FORMS[metric_class.kind]
+
+        for job in jobs:
+            job.invalidate_memos()
+        at_bin_time, at_bin_results = time_call(run_at_bin, metric_inst, calculate_at_bin, span, jobs, bin_times)
+
+        for job in jobs:
+            job.invalidate_memos()
+        over_bins_time, over_bins_results = time_call(run_over_bins, metric_inst, jobs, bin_times)
+
+        if normalise(at_bin_results) != normalise(over_bins_results):
+            raise RuntimeError("The paths disagreed on the results of metric %s!" % metric_class.__name__)
+
+        print "    %-38s %8.3fs %8.3fs  (x%.1f)" % (
+            metric_class.__name__, at_bin_time, over_bins_time, at_bin_time / max(over_bins_time, 1e-9))
+
+
+def filter_by_exceptions(metric_insts, jobs):
+    """returns each metric's valid jobs, found by seeking (and catching the failure to get) each job's values"""
+    all_valid_jobs = []
+    for metric_inst in metric_insts:
+        valid_jobs = daemon.JobList()
+        for job in jobs:
+            try:
+                job.get_values(metric_inst.tags)
+                job.get_values(metric_inst.fields)
+                job.get_values(metric_inst.cache)
+                valid_jobs.append(job)
+            except RuntimeError:
+                pass
+        all_valid_jobs.append(valid_jobs)
+    return all_valid_jobs
+
+
+def filter_by_index(metric_insts, jobs):
+    """returns each metric's valid jobs, found by AND-ing the bitmaps of a FieldIndex built in one pass"""
+    fields = set()
+    for metric_inst in metric_insts:
+        fields.update(metric_inst.tags + metric_inst.fields + metric_inst.cache)
+    index = daemon.FieldIndex(jobs, fields)
+    return [index.get_jobs(daemon.MetricManager._get_valid_bitmap(metric_inst, index)) for metric_inst in metric_insts]
+
+
+def benchmark_job_filtering(jobs, bin_times):
+    """compares filtering the jobs for the fields of each default metric (and of one only some jobs suit) both ways"""
+    print "filtering by exceptions vs by a field index:"
+    metric_insts = [metric_class() for metric_class in get_default_metrics()]
+    metric_insts.append(type("BenchmarkMetric", (object,), {
+        'db': "benchmark", 'mes': "sparse", 'tags': ["SUBMIT_SITE", "BATCH_JOB_SITE"], 'fields': [], 'cache': []})())
+
+    for job in jobs:
+        job.invalidate_memos()
+    exceptions_time, exceptions_jobs = time_call(filter_by_exceptions, metric_insts, jobs)
+
+    for job in jobs:
+        job.invalidate_memos()
+    index_time, index_jobs = time_call(filter_by_index, metric_insts, jobs)
+
+    if exceptions_jobs != index_jobs:
+        raise RuntimeError("The filters disagreed on the valid jobs!")
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % (
+        "%s metrics" % len(metric_insts), exceptions_time, index_time, exceptions_time / max(index_time, 1e-9))
+
+
+def benchmark_kind_kernels(jobs, bin_times):
+    """compares each metric kind's interpreted kernel, visiting each job in turn, against its vectorized kernel"""
+    if daemon.numpy is None:
+        print "interpreted vs vectorized kinds: skipped (NumPy isn't installed)"
+        return
+
+    print "interpreted vs vectorized kinds:"
+    for kind in ["count_running", "count_idle", "sum_rate(RemoteUserCpu)", "time_average(RemoteSysCpu)"]:
+        metric_class = type("BenchmarkMetric", (object,), {
+            'db': "benchmark", 'mes': kind, 'tags': ["SUBMIT_SITE", "Owner"], 'fields': [], 'cache': [], 'kind': kind})
+        daemon.MetricKind.prepare(metric_class)
+        metric_inst = metric_class()
+
+        kind_results = []
+        kind_times = []
+        for numpy_module in [None, daemon.numpy]:
+            daemon.numpy = numpy_module
+            for job in jobs:
+                job.invalidate_memos()
+            kind_time, results = time_call(run_over_bins, metric_inst, daemon.JobList(jobs), bin_times)
+            kind_times.append(kind_time)
+            kind_results.append(normalise(results))
+
+        if kind_results[0] != kind_results[1]:
+            raise RuntimeError("The kernels disagreed on the results of kind %s!" % kind)
+
+        print "    %-38s %8.3fs %8.3fs  (x%.1f)" % (
+            kind, kind_times[0], kind_times[1], kind_times[0] / max(kind_times[1], 1e-9))
+
+
+def interpolate_per_job(jobs, fields, t):
+    """returns each field's values of every job at t, interpolated one job at a time"""
+    return [[job.get_value_when_running_at(field, t) for job in jobs] for field in fields]
+
+
+def interpolate_in_batch(jobs, fields, t):
+    """returns each field's values of every job at t, interpolated for every job at once"""
+    table = daemon.JobList(jobs).table
+    return [table.get_values_when_running_at(field, t).tolist() for field in fields]
+
+
+def benchmark_cache_interpolation(jobs, bin_times):
+    """compares interpolating the cached fields of every job to be cached one job at a time against at once"""
+    if daemon.numpy is None:
+        print "per job vs batch interpolation: skipped (NumPy isn't installed)"
+        return
+
+    print "per job vs batch interpolation:"
+    cached_jobs = [job for job in jobs if daemon.Cache.is_to_be_cached(job)]
+    fields = [daemon.Ad.remote_user_cpu_duration, daemon.Ad.remote_sys_cpu_duration]
+    t = bin_times[-1] + BIN_DURATION
+
+    for job in jobs:
+        job.invalidate_memos()
+    per_job_time, per_job_vals = time_call(interpolate_per_job, cached_jobs, fields, t)
+
+    for job in jobs:
+        job.invalidate_memos()
+    batch_time, batch_vals = time_call(interpolate_in_batch, cached_jobs, fields, t)
+
+    if per_job_vals != batch_vals:
+        raise RuntimeError("The interpolations disagreed on the jobs' values!")
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % ("%s jobs, %s fields" % (len(cached_jobs), len(fields)),
+                                               per_job_time, batch_time, per_job_time / max(batch_time, 1e-9))
+
+    # jobs whose ads lack a cached field must be interpolated alike too (so new jobs are made, to be changed)
+    lacking_jobs = [job for job in make_jobs(len(jobs), bin_times, seed=1) if daemon.Cache.is_to_be_cached(job)]
+    for job in lacking_jobs[::2]:
+        del job.ad[daemon.Ad.remote_sys_cpu_duration]
+    if interpolate_per_job(lacking_jobs, fields, t) != interpolate_in_batch(lacking_jobs, fields, t):
+        raise RuntimeError("The interpolations disagreed on the values of jobs lacking a field!")
+
+
+def run_cache_store(store_class, values, t):
+    """
+    saves the values to a new store, then (as the next run does) loads the store and looks up every job, and
+    saves the values of the next run (in which the running jobs' values grew), which are checked by loading
+    them back
+    """
+    store_class().save(t - BIN_DURATION, values)
+    next_values = dict([(job_id, (status, dict([(field, val + BIN_DURATION * (status == daemon.Job.Status.RUNNING))
+                                                for field, val in jobvals.iteritems()])))
+                        for job_id, (status, jobvals) in values.iteritems()])
+    t0 = time.time()
+    store = store_class()
+    for job_id in values:
+        store.get(job_id)
+    load_time = time.time() - t0
+
+    t0 = time.time()
+    store.save(t, next_values)
+    save_time = time.time() - t0
+
+    store = store_class()
+    loaded = dict([(job_id, tuple(store.get(job_id))) for job_id in values])
+    return save_time, load_time, loaded == next_values
+
+
+def benchmark_cache_stores(jobs, bin_times):
+    """compares saving, and then loading and looking up every active job in, each store of the cache"""
+    print "cache stores (save, load):"
+    values = {}
+    for job in jobs:
+        if job.is_active():
+            values[job.id] = (job.status, dict([(field, job.ad[field]) for field in [
+                daemon.Ad.remote_user_cpu_duration, daemon.Ad.remote_sys_cpu_duration]]))
+
+    # each store's files are written in a new temporary directory
+    directory = os.getcwd()
+    for name in sorted(daemon.Cache.STORES):
+        os.chdir(tempfile.mkdtemp())
+        try:
+            save_time, load_time, agreed = run_cache_store(daemon.Cache.STORES[name], values, bin_times[-1])
+        finally:
+            shutil.rmtree(os.getcwd())
+            os.chdir(directory)
+
+        if not agreed:
+            raise RuntimeError("The %s cache store didn't load the values it saved!" % name)
+
+        print "    %-38s %8.3fs %8.3fs" % ("%s (%s jobs)" % (name, len(values)), save_time, load_time)
+
+
+class StandInInfluxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """accepts (and counts the bytes of) influx queries and writes, with keep-alive connections"""
+    protocol_version = 'HTTP/1.1'
+
+    # responses are buffered (and sent whole, as influx does), rather than each header sent separately
+    wbufsize = -1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        self.server.num_bytes += len(body)
+        if self.path.startswith('/write'):
+            time.sleep(self.server.latency)
+        resp = '' if self.path.startswith('/write') else '{"results":[{}]}'
+        self.send_response(204 if self.path.startswith('/write') else 200)
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInInfluxServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """a local stand-in influx server, serving each connection in its own thread"""
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInInfluxHandler)
+        self.num_bytes = 0
+        self.latency = latency
+        self.url = 'http://127.0.0.1:%s/' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def make_lines(num_lines):
+    """returns num_lines lines of line protocol, as the default metrics' results become"""
+    rnd = random.Random(0)
+    data = [(rnd.randint(0, 1000), {"SUBMIT_SITE": "SITE%s" % rnd.randint(0, 4), "Owner": "user%s" % i})
+            for i in range(num_lines)]
+    return daemon.NetworkManager.stringify_bin_data("running jobs", data, int(time.time())).split('\n')
+
+
+def push_with_new_connections(url, fragments):
+    """pushes each fragment by a new connection (as http_connect did, by a new urllib2 opener each request)"""
+    for fragment in fragments:
+        request = urllib2.Request(url + 'write?db=benchmark', fragment)
+        request.get_method = lambda: "POST"
+        urllib2.build_opener().open(request).read()
+
+
+def push_with_pool(url, fragments, compression_level=0, compression_min_bytes=0):
+    """pushes each fragment by http_connect, over the pool's keep-alive connections"""
+    for fragment in fragments:
+        daemon.NetworkManager.http_connect(url + 'write?db=benchmark', fragment,
+                                           compression_level, compression_min_bytes)
+
+
+def benchmark_influx_writes(num_lines):
+    """compares pushing lines (in fragments, as the outbox does) to a local stand-in influx by each method"""
+    print "new connections vs pooled connections (local stand-in influx):"
+    server = StandInInfluxServer()
+    lines = make_lines(num_lines)
+    fragments = ['\n'.join(lines[i: i + LINES_PER_FRAGMENT])
+                 for i in range(0, len(lines), LINES_PER_FRAGMENT)]
+
+    new_time, _ = time_call(push_with_new_connections, server.url, fragments)
+    daemon.NetworkManager.connection_pool = daemon.HttpConnectionPool()
+    pool_time, _ = time_call(push_with_pool, server.url, fragments)
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % ("%s lines in %s requests" % (len(lines), len(fragments)),
+                                               new_time, pool_time, new_time / max(pool_time, 1e-9))
+    print "    (the pool %s)" % daemon.NetworkManager.connection_pool.get_report()
+    server.shutdown()
+
+
+def benchmark_write_compression(num_lines):
+    """compares the bytes received by a local stand-in influx, and the time taken, at each gzip level"""
+    print "write compression (bytes received by a local stand-in influx):"
+    lines = make_lines(num_lines)
+    fragments = ['\n'.join(lines[i: i + LINES_PER_FRAGMENT])
+                 for i in range(0, len(lines), LINES_PER_FRAGMENT)]
+
+    for level in [0, 1, 6, 9]:
+        server = StandInInfluxServer()
+        daemon.NetworkManager.connection_pool = daemon.HttpConnectionPool()
+        daemon.NetworkManager.body_stats = dict.fromkeys(daemon.NetworkManager.body_stats, 0)
+        push_time, _ = time_call(push_with_pool, server.url, fragments, level)
+        print "    %-38s %10s bytes %8.3fs  (%.3fs compressing)" % (
+            "level %s" % level if level else "uncompressed", server.num_bytes, push_time,
+            daemon.NetworkManager.body_stats['compression time'])
+        server.shutdown()
+
+
+class StandInOutboxConfig(object):
+    """the config settings consulted by the outbox, for a stand-in influx"""
+    influx_username = "admin"
+    influx_password = "benchmark"
+    write_compression_level = 0
+    write_compression_min_bytes = 0
+    write_batch_bytes = daemon.Config.JSON_VALUE_WRITE_BATCH_BYTES_DEFAULT
+    write_workers_per_database = daemon.Config.JSON_VALUE_WRITE_WORKERS_PER_DATABASE_DEFAULT
+    outbox_max_bytes = daemon.Config.JSON_VALUE_OUTBOX_MAX_BYTES_DEFAULT
+    known_database_ttl = daemon.Config.JSON_VALUE_KNOWN_DATABASE_TTL_DEFAULT
+
+    def __init__(self, url):
+        self.database_url = url
+
+
+def in_temporary_directory(func, *args):
+    """returns the result of calling func with args in a new temporary directory, which is then deleted"""
+    directory = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        return func(*args)
+    finally:
+        shutil.rmtree(os.getcwd())
+        os.chdir(directory)
+
+
+def drain_spool(url, lines, databases):
+    """spools the lines for each database, then times a new outbox finding and pushing them all"""
+    outbox = daemon.Outbox(StandInOutboxConfig(url))
+    for database in databases:
+        outbox._add_chunk(database, '\n'.join(lines))
+    outbox.save()
+
+    daemon.NetworkManager.connection_pool = daemon.HttpConnectionPool()
+    drain_time, outbox = time_call(daemon.Outbox, StandInOutboxConfig(url))
+    if outbox.segments or os.listdir(daemon.FileManager.DIR_OUTBOX):
+        raise RuntimeError("The outbox failed to push to the stand-in influx!")
+    return drain_time
+
+
+def benchmark_outbox_drain(num_lines, databases=('benchmark', 'benchmark_2')):
+    """
+    compares draining a backlog of lines in each database, to a stand-in influx which takes a while to respond to
+    each write, by sequential fragments of LINES_PER_FRAGMENT lines vs the outbox's concurrent byte-sized segments
+    """
+    print "outbox drain, sequential line fragments vs concurrent byte segments (%.0fms per write):" % (
+        1000 * STAND_IN_INFLUX_LATENCY)
+    server = StandInInfluxServer(STAND_IN_INFLUX_LATENCY)
+    lines = make_lines(num_lines)
+    fragments = ['\n'.join(lines[i: i + LINES_PER_FRAGMENT])
+                 for i in range(0, len(lines), LINES_PER_FRAGMENT)]
+
+    daemon.NetworkManager.connection_pool = daemon.HttpConnectionPool()
+    sequential_time, _ = time_call(lambda: [push_with_pool(server.url, fragments) for _ in databases])
+    concurrent_time = in_temporary_directory(drain_spool, server.url, lines, databases)
+    server.shutdown()
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % ("%s lines in %s databases" % (len(lines), len(databases)),
+                                               sequential_time, concurrent_time,
+                                               sequential_time / max(concurrent_time, 1e-9))
+
+
+def buffer_by_concatenation(bins, database='benchmark'):
+    """
+    adds the bins' data to a single string which is saved to, and loaded from, a JSON file (as the outbox once
+    was), then split into fragments of LINES_PER_FRAGMENT lines, returning their number
+    """
+    outgoing = {}
+    for mes, data, t in bins:
+        if database in outgoing:
+            outgoing[database] += "\n" + daemon.NetworkManager.stringify_bin_data(mes, data, t)
+        else:
+            outgoing[database] = daemon.NetworkManager.stringify_bin_data(mes, data, t)
+    daemon.FileManager.write_json_to_file(outgoing, daemon.FileManager.FN_OUTBOX)
+    outgoing = daemon.FileManager.load_file(daemon.FileManager.FN_OUTBOX)
+    lines = outgoing[database].split('\n')
+    fragments = ['\n'.join(lines[i: i + LINES_PER_FRAGMENT]) for i in range(0, len(lines), LINES_PER_FRAGMENT)]
+    return len(fragments)
+
+
+def buffer_by_spool(bins, database='benchmark'):
+    """
+    adds the bins' data to the outbox's spool, then makes a new outbox from it (with influx unreachable, so that
+    each segment is read but kept), returning its size report
+    """
+    outbox = daemon.Outbox(StandInOutboxConfig('http://127.0.0.1:1/'))
+    for mes, data, t in bins:
+        outbox.add(database, mes, data, t)
+    outbox.save()
+    return daemon.Outbox(StandInOutboxConfig('http://127.0.0.1:1/')).get_size_report()
+
+
+def benchmark_outbox_buffer(bin_times, lines_per_bin):
+    """
+    compares adding a backlog of bins' data to the outbox, keeping it for the next run and loading it again, by a
+    concatenated string in a JSON file vs the spool of segments
+    """
+    print "outbox buffer, concatenated JSON vs spool (add, save and load):"
+    rnd = random.Random(0)
+    bins = [("running jobs", [(rnd.randint(0, 1000), {"SUBMIT_SITE": "SITE%s" % (i % 5), "Owner": "user%s" % i})
+                              for i in range(lines_per_bin)], t) for t in bin_times]
+
+    concatenation_time, _ = time_call(in_temporary_directory, buffer_by_concatenation, bins)
+
+    # the outbox's errors at the unreachable influx aren't of interest
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        spool_time, report = time_call(in_temporary_directory, buffer_by_spool, bins)
+    finally:
+        sys.stdout = stdout
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % ("%s lines over %s bins" % (lines_per_bin * len(bins), len(bins)),
+                                               concatenation_time, spool_time,
+                                               concatenation_time / max(spool_time, 1e-9))
+    print "    (the outbox %s)" % report
+
+
+def stringify_bin_data_uncached(mes, data, t):
+    """formats the bin data as NetworkManager.stringify_bin_data once did, escaping every tag of every line"""
+    if not data:
+        return ""
+    mes = daemon.NetworkManager._stringify_measurement(mes, [tag for tag in data[0][1]])
+    body = ""
+    for datum in data:
+        tags = ','.join(['%s=%s' % (
+            daemon.NetworkManager._stringify_tag_name_or_val(tag),
+            daemon.NetworkManager._stringify_tag_name_or_val(datum[1][tag]))
+                         for tag in datum[1]])
+        if isinstance(datum[0], dict):
+            fields = ','.join(['%s=%s' % (daemon.NetworkManager._stringify_tag_name_or_val(field), datum[0][field])
+                               for field in sorted(datum[0])])
+        else:
+            fields = 'value=%s' % datum[0]
+        body += '%s,%s %s %s\n' % (mes, tags, fields, t)
+    return body[:-1]
+
+
+def benchmark_stringify(bin_times, tag_sets_per_bin):
+    """compares stringifying every bin's data (of the same tag sets each bin) without vs with cached series keys"""
+    print "stringify bin data, escaping every line vs cached series keys:"
+    rnd = random.Random(0)
+    tag_sets = [{"SUBMIT_SITE": "SITE %s" % (i % 5), "Owner": "user,%s" % i, "MATCH_EXP_JOB_Site": ""}
+                for i in range(tag_sets_per_bin)]
+    bins = [("running jobs", [(rnd.randint(0, 1000), tags) for tags in tag_sets], t) for t in bin_times]
+    bins += [("cpu quantiles", [({"p50": rnd.random(), "p99": rnd.random()}, tags) for tags in tag_sets], t)
+             for t in bin_times]
+
+    daemon.NetworkManager.series_keys.clear()
+    uncached_time, uncached = time_call(lambda: [stringify_bin_data_uncached(*args) for args in bins])
+    cached_time, cached = time_call(lambda: [daemon.NetworkManager.stringify_bin_data(*args) for args in bins])
+    if cached != uncached:
+        raise RuntimeError("Stringifying with cached series keys disagreed with escaping every line!")
+
+    print "    %-38s %8.3fs %8.3fs  (x%.1f)" % (
+        "%s lines over %s bins" % (tag_sets_per_bin * len(bins), len(bins)),
+        uncached_time, cached_time, uncached_time / max(cached_time, 1e-9))
+
+
+def main():
+    num_jobs = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_NUM_JOBS
+    num_bins = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_NUM_BINS
+
+    first_bin_start_time = int(time.time()) - num_bins * BIN_DURATION
+    bin_times = range(first_bin_start_time, first_bin_start_time + num_bins * BIN_DURATION, BIN_DURATION)
+    jobs = make_jobs(num_jobs, bin_times)
+    print "%s jobs over %s bins of %ss" % (num_jobs, num_bins, BIN_DURATION)
+
+    benchmark_job_filtering(jobs, bin_times)
+    benchmark_metric_paths(jobs, bin_times)
+    benchmark_kind_kernels(jobs, bin_times)
+    benchmark_cache_interpolation(jobs, bin_times)
+    benchmark_cache_stores(jobs, bin_times)
+    benchmark_influx_writes(num_jobs * 10)
+    benchmark_write_compression(num_jobs * 10)
+    benchmark_outbox_drain(num_jobs * 10)
+    benchmark_outbox_buffer(bin_times, num_jobs / 20)
+    benchmark_stringify(bin_times, num_jobs / 20)
+
+
+if __name__ == "__main__":
+    main()
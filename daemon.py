@@ -6,14 +6,33 @@
 # Purpose:      Condorflux daemon; a condor probe for aggregating metric data into influx and grafana
 
 import htcondor
+import itertools
 import urllib2
+import urlparse
+import httplib
+import socket
+import StringIO
+import zlib
 import inspect
 import urllib
+import base64
+import threading
+import Queue
+import os
 import time
+import sqlite3
 import json
+import math
+import hashlib
 import sys
 import re
 
+# NumPy is optional, needed only for vectorized job evaluation (JobTable)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEBUG_PRINT = True
 
 
@@ -95,9 +114,24 @@ class FileManager(object):
     """manages the parsing and writing to of all files used by the daemon"""
     FN_CONFIG = "config.json"
     FN_CACHE = "cache.json"
+    FN_CACHE_DB = "cache.db"
+    FN_CACHE_SNAPSHOT = "cache_snapshot.json"
+    FN_CACHE_LOG = "cache.log"
     FN_OUTBOX = "outbox.json"
+    DIR_OUTBOX = "outbox"
+    FN_HISTORY_CURSORS = "history_cursors.json"
+    FN_KNOWN_DATABASES = "known_databases.json"
     FN_METRICS = "metrics.py"
 
+    # appended to the name of a file whose contents were migrated into another format
+    SUFFIX_MIGRATED = ".migrated"
+
+    # appended to the name of a file being written, until it's complete
+    SUFFIX_TEMP = ".tmp"
+
+    # appended to the name of each of the outbox's segment files (of influx line protocol) in DIR_OUTBOX
+    SUFFIX_SEGMENT = ".lp"
+
     @staticmethod
     def load_file(filename):
         """returns the json object (as ASCII) encoded in file with name filename"""
@@ -127,6 +161,31 @@ class FileManager(object):
         json.dump(obj, f, indent=4)
         f.close()
 
+    @staticmethod
+    def write_json_to_file_atomically(obj, filename):
+        """
+        JSON encodes and writes obj to file filename as write_json_to_file, but to a temporary file first (flushed
+        to disk) which then replaces filename, so that filename is never left partly written. The replacement is
+        flushed to disk too, so that it can't be lost (in a crash) after files written later
+        """
+        temp_filename = filename + FileManager.SUFFIX_TEMP
+        f = open(temp_filename, 'w')
+        json.dump(obj, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(temp_filename, filename)
+        FileManager.sync_directory(filename)
+
+    @staticmethod
+    def sync_directory(filename):
+        """flushes to disk the entries (e.g. a rename) of the directory containing file filename"""
+        fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     @staticmethod
     def write_str_to_file(string, filename):
         f = open(filename, 'w')
@@ -134,6 +193,138 @@ class FileManager(object):
         f.close()
 
 
+class HttpConnectionPool(object):
+    """
+    keeps open (keep-alive) HTTP connections to each server (scheme and host of a URL), so that consecutive
+    requests to it reuse a connection rather than each making a new one (with its TCP and TLS handshakes).
+    Connections are taken from the pool for a request and returned once its response is read, so the pool
+    may be shared between threads. Like urllib2, requests go through the proxies of the environment (e.g.
+    http_proxy, https_proxy and no_proxy)
+    """
+
+    # seconds for which a connection may wait to connect, or for each read, unless the config sets another
+    DEFAULT_TIMEOUT = 60
+
+    def __init__(self):
+        self.idle = {}          # {(scheme, host): [connection, ...]}
+        self.timeout = HttpConnectionPool.DEFAULT_TIMEOUT
+        self.proxies = {}       # {(scheme, host): (proxy host, {proxy header: value}) or None}
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_connections_opened = 0
+
+    def request(self, url, data=None, headers=None):
+        """
+        POSTs data (or nothing) to url, with any extra headers {name: value}, and returns (status, reason,
+        headers, body) of the response. A reused connection which the server has since closed is replaced, and
+        the request retried, once
+        """
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        if scheme not in ['http', 'https'] or not host:
+            raise urllib2.URLError("unsupported URL %s" % url)
+        key = (scheme, host)
+        path = (path or '/') + ('?' + query if query else '')
+
+        # a plain HTTP proxy is sent the whole URL, whereas HTTPS is tunnelled through it (see _open)
+        proxy = self._get_proxy(key)
+        if proxy and scheme == 'http':
+            path = "%s://%s%s" % (scheme, host, path)
+            headers = dict(headers or {}, **proxy[1])
+
+        connection, is_reused = self._take(key)
+        try:
+            try:
+                response, body = self._send(connection, path, data, headers)
+            except (httplib.HTTPException, socket.error):
+                if not is_reused:
+                    raise
+                connection.close()
+                connection, _ = self._open(key)
+                response, body = self._send(connection, path, data, headers)
+        except (httplib.HTTPException, socket.error) as e:
+            connection.close()
+            raise urllib2.URLError(e)
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle.setdefault(key, []).append(connection)
+        return response.status, response.reason, response.msg, body
+
+    def _take(self, key):
+        """returns (a connection to the server, whether it was reused), opening one if none are idle"""
+        with self.lock:
+            self.num_requests += 1
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        return self._open(key)
+
+    def _open(self, key):
+        """returns (a new connection to the server, or to its proxy, False)"""
+        with self.lock:
+            self.num_connections_opened += 1
+        scheme, host = key
+        proxy = self._get_proxy(key)
+        if not proxy:
+            connection_class = httplib.HTTPSConnection if (scheme == 'https') else httplib.HTTPConnection
+            return connection_class(host, timeout=self.timeout), False
+        proxy_host, proxy_headers = proxy
+        if scheme == 'http':
+            return httplib.HTTPConnection(proxy_host, timeout=self.timeout), False
+        connection = httplib.HTTPSConnection(proxy_host, timeout=self.timeout)
+        connection.set_tunnel(host, headers=proxy_headers)
+        return connection, False
+
+    def _get_proxy(self, key):
+        """
+        returns (the host of the proxy, {header: value} authenticating with it) through which requests to the
+        server are to be sent, or None if they're to be sent directly, as given by the environment
+        """
+        with self.lock:
+            if key in self.proxies:
+                return self.proxies[key]
+        scheme, host = key
+        proxy = urllib.getproxies().get(scheme)
+        if (not proxy) or urllib.proxy_bypass(host):
+            found = None
+        else:
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            user, proxy_host = urllib.splituser(urlparse.urlsplit(proxy)[1])
+            proxy_headers = {}
+            if user:
+                proxy_headers["Proxy-Authorization"] = "Basic " + base64.b64encode(urllib.unquote(user))
+            found = (proxy_host, proxy_headers)
+        with self.lock:
+            self.proxies[key] = found
+        return found
+
+    @staticmethod
+    def _send(connection, path, data, extra_headers=None):
+        """sends a POST of data to the connection and returns (its response, the response's body)"""
+        headers = {"Connection": "keep-alive"}
+        if data:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if extra_headers:
+            headers.update(extra_headers)
+        connection.request("POST", path, data or '', headers)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def get_report(self):
+        """returns a description of the requests made and connections opened"""
+        return "made %s requests over %s connections" % (self.num_requests, self.num_connections_opened)
+
+    def close(self):
+        """closes every idle connection"""
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle = {}
+
+
 class NetworkManager(object):
     """performs all networking and abstracts all HTTP use/formatting"""
 
@@ -143,31 +334,70 @@ class NetworkManager(object):
     # substituted for a tag's value when that value is otherwise an empty string
     TAG_VALUE_PLACEHOLDER = "unknown"
 
+    # the escaped series key (measurement and tags) of each line, by (escaped measurement name, tag items), since
+    # the same are stringified for every bin. Emptied when it holds SERIES_KEYS_MAX
+    series_keys = {}
+    SERIES_KEYS_MAX = 100000
+
+    # keep-alive connections, reused by every request to the same server
+    connection_pool = HttpConnectionPool()
+
+    # totals over every body POSTed, for judging whether compressing them is worthwhile (updated by many threads)
+    body_stats = {'bodies': 0, 'compressed bodies': 0, 'bytes': 0, 'bytes sent': 0, 'compression time': 0.0}
+    body_stats_lock = threading.Lock()
+
     @staticmethod
-    def http_connect(url, data = False):
-        """opens url, passing data and returns response. May throw network errors"""
-        # TODO Changes made
-        method = "POST"
-        opener = urllib2.build_opener()
+    def http_connect(url, data = False, compression_level=0, compression_min_bytes=0):
+        """
+        POSTs data (if any) to url through the connection pool and returns the response. The data is gzipped
+        (at compression_level, 1-9, where 0 doesn't compress) when at least compression_min_bytes long. Raises
+        urllib2.HTTPError if the response isn't a success (2xx), and urllib2.URLError if the url can't be reached
+        """
+        headers = None
         if data:
             data = data.replace('\n\n', '\n')
+            num_bytes, compression_time = len(data), 0.0
+            if compression_level and num_bytes >= compression_min_bytes:
+                start_time = time.time()
+                data = NetworkManager._gzip(data, compression_level)
+                compression_time = time.time() - start_time
+                headers = {"Content-Encoding": "gzip"}
+            with NetworkManager.body_stats_lock:
+                NetworkManager.body_stats['bodies'] += 1
+                NetworkManager.body_stats['bytes'] += num_bytes
+                NetworkManager.body_stats['bytes sent'] += len(data)
+                if headers:
+                    NetworkManager.body_stats['compressed bodies'] += 1
+                    NetworkManager.body_stats['compression time'] += compression_time
         debug_print("attempting to open %s" % url)
-        if data:
-            req = urllib2.Request(url, data)
-        else:
-            req = urllib2.Request(url)
-        req.get_method = lambda: method
-        connection = opener.open(req)
-        resp = connection.read()
-        # resp = urllib2.urlopen(req).read()
+        status, reason, resp_headers, resp = NetworkManager.connection_pool.request(url, data or None, headers)
+        # redirects aren't followed, so mustn't be mistaken for success (and the data then deleted)
+        if not 200 <= status < 300:
+            raise urllib2.HTTPError(url, status, reason, resp_headers, StringIO.StringIO(resp))
         debug_print("successful! response: %s" % resp)
         return resp
 
+    @staticmethod
+    def _gzip(data, level):
+        """returns data compressed (at level) in the gzip format, as sent with a Content-Encoding of gzip"""
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def get_body_report():
+        """returns a string reporting the bytes of the bodies POSTed, sent and the time spent compressing them"""
+        stats = NetworkManager.body_stats
+        return "sent %s bytes for %s bytes of %s bodies (%.1f%%; %s compressed in %.3fs)" % (
+            stats['bytes sent'], stats['bytes'], stats['bodies'],
+            (100.0*stats['bytes sent']/stats['bytes']) if stats['bytes'] else 100,
+            stats['compressed bodies'], stats['compression time'])
+
     @staticmethod
     def stringify_bin_data(mes, data, t):
         """
         formats data tag separated data for the bin at time t into an influxDB HTTP body, using the
-        measurement name mes. data should be in the format [(val, {tag: val,...}), ...].
+        measurement name mes. data should be in the format [(val, {tag: val,...}), ...], where val is either a
+        single value (of the field 'value') or a dict of field name to value (e.g. from Bin.get_quantiles)
         """
         # no data yields empty string
         if not data:
@@ -175,16 +405,35 @@ class NetworkManager(object):
 
         # reformat the measurement name
         mes = NetworkManager._stringify_measurement(mes, [tag for tag in data[0][1]])
-        body = ""
+
+        series_keys = NetworkManager.series_keys
+        if len(series_keys) >= NetworkManager.SERIES_KEYS_MAX:
+            series_keys.clear()
+
+        timestamp = ' %s' % t
+        lines = []
         for datum in data:
-            tags = ','.join(['%s=%s' % (
-                NetworkManager._stringify_tag_name_or_val(tag),
-                NetworkManager._stringify_tag_name_or_val(datum[1][tag]))
-                             for tag in datum[1]])
-            body += '%s,%s value=%s %s\n' % (mes, tags, datum[0], t)
+            vals, tags = datum[0], datum[1]
+
+            # the tags are escaped only the first time they're seen with this measurement
+            key = (mes, tuple(tags.iteritems()))
+            series_key = series_keys.get(key)
+            if series_key is None:
+                series_key = series_keys[key] = NetworkManager._stringify_series_key(mes, key[1])
+            if isinstance(vals, dict):
+                fields = ','.join(['%s=%s' % (NetworkManager._stringify_tag_name_or_val(field), vals[field])
+                                   for field in sorted(vals)])
+            else:
+                fields = 'value=%s' % vals
+            lines.append(series_key + fields + timestamp)
+        return '\n'.join(lines)
 
-        # cut off trailing newline
-        return body[:-1]
+    @staticmethod
+    def _stringify_series_key(mes, tag_items):
+        """returns the start of a line (up to its fields) of the escaped measurement mes, with tags [(tag, val), ...]"""
+        return '%s,%s ' % (mes, ','.join(['%s=%s' % (NetworkManager._stringify_tag_name_or_val(tag),
+                                                     NetworkManager._stringify_tag_name_or_val(val))
+                                          for tag, val in tag_items]))
 
     @staticmethod
     def _stringify_measurement(mes, tags):
@@ -213,9 +462,15 @@ class NetworkManager(object):
 
 
 class Outbox(object):
-    """stores growing data to be pushed to the database"""
-    # maximum number of time points to send influx in a single HTTP request
-    HTTP_LINES_MAX = 300
+    """
+    stores growing data to be pushed to the database, in a spool directory (FileManager.DIR_OUTBOX) of segment
+    files, each holding lines (as stringified for influx) of a single database, up to a single write's worth.
+    Lines are appended to their database's newest segment as they're added, and each segment is deleted once it's
+    written to influx, so that a run which dies loses no lines, and one which doesn't needn't rewrite them
+    """
+
+    # found in the error of a write to a database which doesn't exist
+    INFLUX_DATABASE_NOT_FOUND = "database not found"
 
     def __init__(self, config):
         """requires handles to the config (for grabbing db url) and the cache (for existing outbox)"""
@@ -227,16 +482,110 @@ class Outbox(object):
 
         self.influx_username = config.influx_username
         self.influx_password = config.influx_password
-
-        # load outbox from file (default to empty if can't read; doesn't delete outbox)
+        self.compression_level = config.write_compression_level
+        self.compression_min_bytes = config.write_compression_min_bytes
+        self.batch_bytes = config.write_batch_bytes
+        self.workers_per_database = max(1, config.write_workers_per_database)
+        self.max_bytes = config.outbox_max_bytes
+        self.known_database_ttl = config.known_database_ttl
+
+        # round trips to influx made this run
+        self.num_creates = 0
+        self.num_writes = 0
+
+        # load the databases created (or found to exist) by previous runs, and when
         try:
-            self.outgoing = FileManager.load_file(FileManager.FN_OUTBOX)  # { db name: "body", ...}
+            self.known_databases = FileManager.load_file(FileManager.FN_KNOWN_DATABASES)   # {db name: time, ...}
         except IOError:
-            self.outgoing = {}
+            self.known_databases = {}
+
+        self.segments = {}          # {db name: [[number, bytes], ...], ...} of its segments, oldest first
+        self.open_files = {}        # {db name: file} of the newest segment of each database appended to this run
+        self.next_number = 0
+
+        # find the segments left by previous runs (by their names and sizes, without reading their lines)
+        if not os.path.isdir(FileManager.DIR_OUTBOX):
+            os.mkdir(FileManager.DIR_OUTBOX)
+        for filename in sorted(os.listdir(FileManager.DIR_OUTBOX)):
+            if not filename.endswith(FileManager.SUFFIX_SEGMENT):
+                continue
+            parsed = Outbox._parse_segment_filename(filename)
+            if parsed is None:
+                print "Warning! The outbox directory (%s) holds %s, which isn't named as a segment, so was skipped" % (
+                    FileManager.DIR_OUTBOX, filename)
+                continue
+            number, database = parsed
+            num_bytes = Outbox._repair_segment(os.path.join(FileManager.DIR_OUTBOX, filename))
+            if num_bytes:
+                self.segments.setdefault(database, []).append([number, num_bytes])
+            self.next_number = max(self.next_number, number + 1)
+
+        # an outbox.json of an older daemon is migrated into the spool
+        if os.path.exists(FileManager.FN_OUTBOX):
+            self._migrate()
 
         # push previously failed data, keep failures
         self.push_outgoing()
 
+    def _migrate(self):
+        """appends the lines of an older daemon's outbox file to the spool, then renames the file"""
+        outgoing = FileManager.load_file(FileManager.FN_OUTBOX)
+        for database in outgoing:
+
+            # outboxes saved before chunking hold each database's lines in a single string
+            chunks = outgoing[database]
+            if isinstance(chunks, basestring):
+                chunks = [chunks]
+            for chunk in chunks:
+                if chunk:
+                    self._add_chunk(database, chunk)
+        self._close_segments()
+        os.rename(FileManager.FN_OUTBOX, FileManager.FN_OUTBOX + FileManager.SUFFIX_MIGRATED)
+        print "Migrated the outbox from %s into %s (keeping the former as %s)" % (
+            FileManager.FN_OUTBOX, FileManager.DIR_OUTBOX, FileManager.FN_OUTBOX + FileManager.SUFFIX_MIGRATED)
+
+    @staticmethod
+    def _get_segment_filename(number, database):
+        """returns the path of the database's segment with the given number"""
+        return os.path.join(FileManager.DIR_OUTBOX, "%012d_%s%s" % (
+            number, urllib.quote(database, safe=''), FileManager.SUFFIX_SEGMENT))
+
+    @staticmethod
+    def _parse_segment_filename(filename):
+        """
+        returns (number, database) of the segment with the given file name, or None if it isn't the name of a
+        segment (i.e. as given by _get_segment_filename)
+        """
+        try:
+            number, database = filename[:-len(FileManager.SUFFIX_SEGMENT)].split('_', 1)
+            number, database = int(number), urllib.unquote(database)
+        except ValueError:
+            return None
+        if Outbox._get_segment_filename(number, database) != os.path.join(FileManager.DIR_OUTBOX, filename):
+            return None
+        return number, database
+
+    @staticmethod
+    def _repair_segment(filename):
+        """
+        returns the size of the segment file, after cutting off a final line torn by a run which died while
+        appending it (every line appended ends with a newline). An empty segment is deleted
+        """
+        with open(filename, 'r+b') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != '\n':
+                    f.seek(0)
+                    size = f.read().rfind('\n') + 1
+                    f.truncate(size)
+                    print "Warning! The outbox's segment %s ended with an incomplete line, which was discarded" % (
+                        filename)
+        if not size:
+            os.remove(filename)
+        return size
+
     def add(self, db, mes, data, t):
         """adds the bin data for time t to the outbox, to be pushed to influx under measurement mes and database db"""
 
@@ -244,76 +593,483 @@ class Outbox(object):
         if not data:
             return
 
-        if db in self.outgoing:
-            self.outgoing[db] += "\n" + NetworkManager.stringify_bin_data(mes, data, t)
-        else:
-            self.outgoing[db] = NetworkManager.stringify_bin_data(mes, data, t)
+        self._add_chunk(db, NetworkManager.stringify_bin_data(mes, data, t))
+
+    def _add_chunk(self, database, chunk):
+        """
+        appends the chunk of lines to the database's newest segment (starting a new one when it's a write's worth),
+        evicting the oldest segments if the spool grows too big
+        """
+        for piece in ([chunk] if len(chunk) <= self.batch_bytes else Outbox._split_chunk(chunk, self.batch_bytes)):
+            segment_bytes = self.segments[database][-1][1] if database in self.open_files else None
+            if (segment_bytes is None) or (segment_bytes and segment_bytes + len(piece) + 1 > self.batch_bytes):
+                self._open_segment(database)
+            self.open_files[database].write(piece + '\n')
+            self.segments[database][-1][1] += len(piece) + 1
+
+        # lines reach the file as they're added (though are only synced to disk when the outbox is saved)
+        if database in self.open_files:
+            self.open_files[database].flush()
+        if self.get_num_bytes() > self.max_bytes:
+            self._evict()
+
+    def _open_segment(self, database):
+        """closes the database's newest segment (if open) and opens a new one to be appended to"""
+        if database in self.open_files:
+            self.open_files.pop(database).close()
+        number = self.next_number
+        self.next_number += 1
+        self.open_files[database] = open(Outbox._get_segment_filename(number, database), 'ab')
+        self.segments.setdefault(database, []).append([number, 0])
+
+    def _close_segments(self):
+        """syncs to disk, and closes, every segment opened this run"""
+        for f in self.open_files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.open_files = {}
+
+    def _evict(self):
+        """deletes the oldest segments (of any database) until the spool is within its maximum size"""
+        num_segments, num_bytes = 0, 0
+        while self.get_num_bytes() > self.max_bytes:
+            database = min(self.segments, key=lambda db: self.segments[db][0][0])
+            number, segment_bytes = self.segments[database].pop(0)
+            if not self.segments[database]:
+                del self.segments[database]
+                if database in self.open_files:
+                    self.open_files.pop(database).close()
+            os.remove(Outbox._get_segment_filename(number, database))
+            num_segments += 1
+            num_bytes += segment_bytes
+        print ("Error! The outbox exceeded %s bytes (%s in %s) " % (
+                    self.max_bytes, Config.JSON_FIELD_OUTBOX_MAX_BYTES, FileManager.FN_CONFIG) +
+               "so its oldest %s segments (%s bytes) were dropped!\nContinuing..." % (num_segments, num_bytes))
+
+    def get_num_bytes(self):
+        """returns the number of bytes of lines held by the outbox"""
+        return sum([segment[1] for segments in self.segments.values() for segment in segments])
+
+    def get_size_report(self):
+        """returns a description of the size of the outbox"""
+        return "holds %s bytes in %s segments for %s databases" % (
+            self.get_num_bytes(), sum([len(segments) for segments in self.segments.values()]), len(self.segments))
+
+    @staticmethod
+    def _split_chunk(chunk, max_bytes):
+        """
+        returns the chunk split between its lines into pieces of at most max_bytes (as near as possible without
+        splitting a line; a single longer line is a piece of its own)
+        """
+        pieces = []
+        start = 0
+        while len(chunk) - start > max_bytes:
+            end = chunk.rfind('\n', start, start + max_bytes + 1)
+            if end == -1:
+                end = chunk.find('\n', start + max_bytes)
+                if end == -1:
+                    break
+            pieces.append(chunk[start:end])
+            start = end + 1
+        pieces.append(chunk[start:])
+        return pieces
+
+    def _push_segments(self, database, numbers, failures):
+        """
+        returns threads (started) which write the database's segments (by their numbers) to it, with at most the
+        config's workers per database in flight at once. Each segment written is deleted, and each which fails is
+        added to failures as (number, reason)
+        """
+        args = urllib.urlencode(
+                {'db': database,
+                 'precision': 's',
+                 'u': self.influx_username,
+                 'p': self.influx_password})
+        tasks = Queue.Queue()
+        for number in numbers:
+            tasks.put(number)
+
+        def work():
+            while True:
+                try:
+                    number = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+
+                # try to push each segment (read only now, so only those in flight are in memory), saving failures
+                filename = Outbox._get_segment_filename(number, database)
+                try:
+                    with open(filename, 'rb') as f:
+                        body = f.read()[:-1]
+                    NetworkManager.http_connect(self.url + 'write?' + args, body,
+                                                self.compression_level, self.compression_min_bytes)
+                except urllib2.HTTPError as e:
+                    failures.append((number, e.read()))
+                    continue
+                except urllib2.URLError as e:
+                    failures.append((number, "the URL in the config (%s in %s) is bad: %s" % (
+                                               Config.JSON_FIELD_DATABASE_URL, FileManager.FN_CONFIG, e.reason)))
+                    continue
+                except IOError as e:
+                    failures.append((number, "its segment couldn't be read: %s" % e))
+                    continue
+
+                # anything else must still be recorded, else the worker dies and its segment is lost from the outbox
+                except Exception as e:
+                    failures.append((number, "its write failed unexpectedly: %s" % e))
+                    continue
+                try:
+                    os.remove(filename)
+                except OSError as e:
+                    failures.append((number, "it was written, but its segment couldn't be deleted: %s" % e))
+
+        threads = [threading.Thread(target=work) for _ in range(min(self.workers_per_database, len(numbers)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _is_known(self, database):
+        """returns whether the database was created (or found to exist) within the config's TTL"""
+        confirmed_time = self.known_databases.get(database)
+        return (confirmed_time is not None) and (time.time() - confirmed_time < self.known_database_ttl)
+
+    def _create_database(self, database):
+        """ensures the database exists (if it fails, maybe pushes to this db won't fail?), recording it if so"""
+        self.num_creates += 1
+        try:
+            query = "CREATE DATABASE %s" % database
+            # TODO fix deprecated use of static database access, change to post request
+            NetworkManager.http_connect(
+                    self.url + 'query?' + urllib.urlencode({'q': query,
+                                                            'u': self.influx_username,
+                                                            'p': self.influx_password}))
+            self.known_databases[database] = int(time.time())
+        except urllib2.HTTPError:
+            print "Error! Attempting to create database %s if nonexistant failed! Continuing..." % database
+        except urllib2.URLError:
+            print "Error! The URL in the config (%s in %s) is bad.\nContinuing..." % (
+                            Config.JSON_FIELD_DATABASE_URL,
+                            FileManager.FN_CONFIG)
+
+    def _push_all_segments(self, numbers):
+        """
+        pushes the segments {db name: [number, ...], ...} of every database at once, returning the failures
+        {db name: [(number, reason), ...], ...}
+        """
+        failures = {}
+        threads = []
+        for database in numbers:
+            failures[database] = []
+            threads += self._push_segments(database, numbers[database], failures[database])
+            self.num_writes += len(numbers[database])
+        for thread in threads:
+            thread.join()
+        return failures
 
     def push_outgoing(self):
         """pushes data to the database, keeps failed pushes"""
 
         debug_print("Checking and pushing the outbox")
+        start_time = time.time()
+
+        # the segments appended to this run are written whole
+        self._close_segments()
+
+        # only databases not known to exist are created before being pushed to
+        for database in self.segments:
+            if not self._is_known(database):
+                self._create_database(database)
+        failures = self._push_all_segments(dict([(database, [number for number, _ in self.segments[database]])
+                                                 for database in self.segments]))
+
+        # a known database which influx couldn't find (e.g. since dropped) is created, and its segments pushed again
+        retries = {}
+        for database in failures:
+            if [reason for _, reason in failures[database] if Outbox.INFLUX_DATABASE_NOT_FOUND in reason]:
+                debug_print("Database %s wasn't found, so is created again" % database)
+                self.known_databases.pop(database, None)
+                self._create_database(database)
+                retries[database] = [number for number, _ in failures[database]]
+        failures.update(self._push_all_segments(retries))
+
+        # keep each failed segment (the others were deleted once written)
+        for database in failures:
+            failed = set([number for number, _ in failures[database]])
+            if failed:
+                print ("Error! Pushing %s of %s segments to database %s at %s failed!\n" % (
+                            len(failed), len(self.segments[database]), database, self.url) +
+                       "(%s)\nContinuing..." % failures[database][0][1])
+                self.segments[database] = [segment for segment in self.segments[database] if segment[0] in failed]
+            else:
+                del self.segments[database]
 
-        failed = {}
-        for database in self.outgoing:
-
-            # ensure database exists (if it fails, maybe pushes to this db won't fail?)
-            try:
-                query = "CREATE DATABASE %s" % database
-		# TODO fix deprecated use of static database access, change to post request
-                NetworkManager.http_connect(
-                        self.url + 'query?' + urllib.urlencode({'q': query,
-                                                                'u': self.influx_username,
-                                                                'p': self.influx_password}))
-            except urllib2.HTTPError:
-                print "Error! Attempting to create database %s if nonexistant failed! Continuing..." % database
-            except urllib2.URLError:
-                print "Error! The URL in the config (%s in %s) is bad.\nContinuing..." % (
-                                Config.JSON_FIELD_DATABASE_URL,
-                                FileManager.FN_CONFIG)
-
-            # database exists; fragment data and push each
-            args = urllib.urlencode(
-                    {'db': database,
-                     'precision': 's',
-                     'u': self.influx_username,
-                     'p': self.influx_password})
-            lines = self.outgoing[database].split('\n')                   # TODO this is lazy inefficient fragments
-            for i in range(0, len(lines), Outbox.HTTP_LINES_MAX):
-                fragment = '\n'.join(lines[i: i + Outbox.HTTP_LINES_MAX])
-
-                # try to push each fragment, saving failures
-                try:
-                    NetworkManager.http_connect(self.url + 'write?' + args, fragment)
-                except urllib2.HTTPError as e:
-                    print ("Error! Pushing some data to database %s at %s failed!\n" % (database, self.url) +
-                           "(%s)\nContinuing..." % e.read())
-                    if database in failed:
-                        failed[database] += '\n' + fragment
-                    else:
-                        failed[database] = fragment
-                except urllib2.URLError:
-                    print ("Error! The URL in the config (%s in %s) is bad. " % (
-                                Config.JSON_FIELD_DATABASE_URL,
-                                FileManager.FN_CONFIG) +
-                           "Continuing...")
-                    if database in failed:
-                        failed[database] += '\n' + fragment
-                    else:
-                        failed[database] = fragment
-
-        debug_print("%s databases were attemptedly pushed to and %s failed" % (len(self.outgoing), len(failed)))
-        self.outgoing = failed
+        debug_print("%s databases were attemptedly pushed to (taking %.3fs) and %s failed" % (
+                        len(failures), time.time() - start_time, len(self.segments)))
+        debug_print("The outbox has made %s round trips this run (%s creating databases, %s writing segments)" % (
+                        self.num_creates + self.num_writes, self.num_creates, self.num_writes))
+        debug_print("The outbox %s" % NetworkManager.connection_pool.get_report())
+        debug_print("The outbox %s" % NetworkManager.get_body_report())
+        debug_print("The outbox %s" % self.get_size_report())
 
     def save(self):
-        """save the outbox back to file"""
-        FileManager.write_json_to_file(self.outgoing, FileManager.FN_OUTBOX)
+        """syncs the lines added to the outbox this run to disk, and saves the databases known to exist"""
+        self._close_segments()
+        FileManager.write_json_to_file_atomically(self.known_databases, FileManager.FN_KNOWN_DATABASES)
+
+
+class JsonCacheStore(object):
+    """
+    keeps the cache as a single JSON file (FileManager.FN_CACHE), read whole when the daemon starts and rewritten
+    whole when it saves
+    """
+
+    def __init__(self):
+
+        # load cache from file, recreating if unable
+        try:
+            j = FileManager.load_file(FileManager.FN_CACHE)
+            self.bin_time = j[Cache.JSON_FIELD_BIN_TIME]                # time (applies to job_values)
+            self.job_values = j[Cache.JSON_FIELD_JOB_VALUES]            # {id: (status, {field: val, ...}), ... }
+        except IOError:
+            self.bin_time = None
+            self.job_values = {}
+
+    def get(self, job_id):
+        """returns the job's cached (status, {field: val, ...}), or None if it isn't cached"""
+        return self.job_values.get(job_id)
+
+    def save(self, t, values):
+        """replaces the cache with values {id: (status, {field: val, ...}), ...} at time t"""
+        obj = {
+            Cache.JSON_FIELD_BIN_TIME: t,
+            Cache.JSON_FIELD_JOB_VALUES: values
+        }
+        FileManager.write_json_to_file_atomically(obj, FileManager.FN_CACHE)
+        self.bin_time = t
+        self.job_values = values
+
+
+class SqliteCacheStore(object):
+    """
+    keeps the cache in an SQLite database (FileManager.FN_CACHE_DB) of a row per cached field of each job, read
+    by a single query when a job's values are first sought, so that a save upserts only the rows which changed
+    and deletes those of jobs (or fields) no longer cached
+    """
+
+    def __init__(self):
+        self._connection = None
+        self._pid = None
+        self.job_values = None      # {id: (status, {field: val, ...}), ...}, once read
+
+        connection = self._get_connection()
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS times (name TEXT PRIMARY KEY, time INTEGER)")
+            connection.execute("CREATE TABLE IF NOT EXISTS job_values (id TEXT, field TEXT, status INTEGER, " +
+                               "value, PRIMARY KEY (id, field))")
+        self.bin_time = self._get_time(Cache.JSON_FIELD_BIN_TIME)
+
+    def _get_connection(self):
+        """returns a connection to the database, opening another in a (forked) process which didn't open it"""
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(FileManager.FN_CACHE_DB)
+            self._connection.text_factory = str
+            self._pid = os.getpid()
+        return self._connection
+
+    def _get_time(self, name):
+        """returns the time of the name in the times table, or None if absent"""
+        row = self._get_connection().execute("SELECT time FROM times WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _get_job_values(self):
+        """returns every cached job's (status, {field: val, ...}), reading them all in one query when first sought"""
+        if self.job_values is None:
+            self.job_values = {}
+            for job_id, field, status, value in self._get_connection().execute(
+                    "SELECT id, field, status, value FROM job_values"):
+                if job_id in self.job_values:
+                    self.job_values[job_id][1][field] = value
+                else:
+                    self.job_values[job_id] = (status, {field: value})
+        return self.job_values
+
+    def get(self, job_id):
+        """returns the job's cached (status, {field: val, ...}), or None if it isn't cached"""
+        return self._get_job_values().get(job_id)
+
+    def save(self, t, values):
+        """
+        replaces the cache with values {id: (status, {field: val, ...}), ...} at time t, upserting the values
+        which changed and deleting those no longer cached, in a single transaction
+        """
+        prev_values = self._get_job_values()
+        upserts = []
+        deletes = []
+        for job_id, (status, jobvals) in values.iteritems():
+            prev_status, prev_jobvals = prev_values.get(job_id, (None, {}))
+            for field, val in jobvals.iteritems():
+                if (status != prev_status) or (field not in prev_jobvals) or (prev_jobvals[field] != val):
+                    upserts.append((job_id, field, status, val))
+            for field in prev_jobvals:
+                if field not in jobvals:
+                    deletes.append((job_id, field))
+        for job_id, (_, prev_jobvals) in prev_values.iteritems():
+            if job_id not in values:
+                deletes.extend([(job_id, field) for field in prev_jobvals])
+
+        with self._get_connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO job_values (id, field, status, value) VALUES (?, ?, ?, ?)", upserts)
+            connection.executemany("DELETE FROM job_values WHERE id = ? AND field = ?", deletes)
+            connection.execute("INSERT OR REPLACE INTO times (name, time) VALUES (?, ?)",
+                               (Cache.JSON_FIELD_BIN_TIME, t))
+        debug_print("The cache store upserted %s values and deleted %s" % (len(upserts), len(deletes)))
+        self.job_values = dict([(job_id, (status, dict(jobvals))) for job_id, (status, jobvals) in values.iteritems()])
+        self.bin_time = t
+
+
+class LogCacheStore(object):
+    """
+    keeps the cache as a JSON snapshot (FileManager.FN_CACHE_SNAPSHOT) and an append-only log of the changes
+    since it (FileManager.FN_CACHE_LOG), so that a save writes only the jobs which joined, left or changed
+    value. Each save's changes are followed by a commit record (of the cache's time) and flushed to disk, so a
+    save torn by a crash is discarded whole when the log is replayed. Once the log grows past COMPACTION_RATIO
+    times the cached jobs, the cache is compacted into a new snapshot (replacing the old only once written)
+    """
+
+    # the log is compacted into the snapshot when it has this many records per cached job
+    COMPACTION_RATIO = 4
+
+    # the types of log records, each a JSON list (on its own line) of the type then its content
+    RECORD_UPSERT = "u"     # ["u", id, status, {field: val, ...}]
+    RECORD_REMOVE = "r"     # ["r", id]
+    RECORD_COMMIT = "c"     # ["c", time]
+
+    # records are encoded compactly, by an encoder made once
+    RECORD_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+    def __init__(self):
+
+        # load the snapshot, starting empty if there's none
+        try:
+            j = FileManager.load_file(FileManager.FN_CACHE_SNAPSHOT)
+            self.bin_time = j[Cache.JSON_FIELD_BIN_TIME]                # time (applies to job_values)
+            self.job_values = j[Cache.JSON_FIELD_JOB_VALUES]            # {id: (status, {field: val, ...}), ... }
+        except IOError:
+            self.bin_time = None
+            self.job_values = {}
+        for job_id in self.job_values:
+            self.job_values[job_id] = tuple(self.job_values[job_id])
+
+        # replay the log's committed changes, then cut off any torn save after them
+        self.num_log_records = 0
+        try:
+            with open(FileManager.FN_CACHE_LOG, 'r+b') as f:
+                committed_size = self._replay(f)
+                if committed_size < os.fstat(f.fileno()).st_size:
+                    print "Warning! The cache's log ended with an incomplete save, which was discarded"
+                    f.truncate(committed_size)
+        except IOError:
+            pass
+
+    def _replay(self, f):
+        """applies each save's changes in the log file f to the cache, returning the size of those committed"""
+
+        # a final line without a newline was torn, as is any line (and those after) which doesn't parse
+        lines = f.read().split('\n')[:-1]
+        try:
+            records = json.loads('[' + ','.join(lines) + ']')
+        except ValueError:
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+
+        pending = []
+        size = committed_size = 0
+        for line, record in itertools.izip(lines, records):
+            size += len(line) + 1
+            if record[0] != LogCacheStore.RECORD_COMMIT:
+                pending.append(record)
+                continue
+
+            # records are parsed whole (as unicode), so only their strings are made ASCII
+            for change in pending:
+                job_id = change[1].encode('utf-8')
+                if change[0] == LogCacheStore.RECORD_UPSERT:
+                    self.job_values[job_id] = (change[2], dict([
+                        (field.encode('utf-8'), val) for field, val in change[3].iteritems()]))
+                else:
+                    self.job_values.pop(job_id, None)
+            self.num_log_records += len(pending) + 1
+            self.bin_time = record[1]
+            committed_size = size
+            pending = []
+        return committed_size
+
+    def get(self, job_id):
+        """returns the job's cached (status, {field: val, ...}), or None if it isn't cached"""
+        return self.job_values.get(job_id)
+
+    def save(self, t, values):
+        """
+        replaces the cache with values {id: (status, {field: val, ...}), ...} at time t, by appending to the
+        log the changes from the current cache (then compacting into a new snapshot, once the log is long)
+        """
+        records = []
+        for job_id, (status, jobvals) in values.iteritems():
+            if self.job_values.get(job_id) != (status, jobvals):
+                records.append([LogCacheStore.RECORD_UPSERT, job_id, status, jobvals])
+        for job_id in self.job_values:
+            if job_id not in values:
+                records.append([LogCacheStore.RECORD_REMOVE, job_id])
+        records.append([LogCacheStore.RECORD_COMMIT, t])
+
+        # the changes are committed to the log even when compacting, so that the log always ends at the cache
+        with open(FileManager.FN_CACHE_LOG, 'ab') as f:
+            f.write(''.join([LogCacheStore.RECORD_ENCODER.encode(record) + '\n' for record in records]))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.job_values = dict([(job_id, tuple(item)) for job_id, item in values.iteritems()])
+        self.bin_time = t
+        self.num_log_records += len(records)
+        if self.num_log_records > LogCacheStore.COMPACTION_RATIO * max(len(self.job_values), 1):
+            self._compact()
+
+    def _compact(self):
+        """
+        writes the cache as the new snapshot, then empties the log. Should the daemon die between, the log
+        (which ends with the cache's own save) is replayed over the new snapshot, and since each job's last
+        record in it is of its value in the cache (and jobs without records are unchanged since the old
+        snapshot), gives the same cache again. The snapshot's rename is on disk before the log is emptied
+        """
+        obj = {
+            Cache.JSON_FIELD_BIN_TIME: self.bin_time,
+            Cache.JSON_FIELD_JOB_VALUES: self.job_values
+        }
+        FileManager.write_json_to_file_atomically(obj, FileManager.FN_CACHE_SNAPSHOT)
+        with open(FileManager.FN_CACHE_LOG, 'wb') as f:
+            os.fsync(f.fileno())
+        self.num_log_records = 0
+        debug_print("Compacted the cache's log into its snapshot")
 
 
 class Cache(object):
     """stores (or assumes) previous values of a job"""
     JSON_FIELD_BIN_TIME = "NEXT INITIAL BIN START TIME"
     JSON_FIELD_JOB_VALUES = "PREVIOUS JOB VALUES"
+    JSON_FIELD_CURSOR_TIME = "CURSOR TIME"
+    JSON_FIELD_CURSORS = "SCHEDD HISTORY CURSORS"
+
+    # the stores in which the cache can be kept, named by the config
+    STORES = {"json": JsonCacheStore,
+              "sqlite": SqliteCacheStore,
+              "log": LogCacheStore}
 
     def __init__(self, config):
         """requires a handle to a Config instance to access a job's initial values"""
@@ -321,47 +1077,124 @@ class Cache(object):
         # { field: [val, state of update, field of init time], ... }
         self.initial_values = config.initial_values
 
-        # load cache from file, recreating if unable
+        if config.cache_store not in Cache.STORES:
+            raise RuntimeError("The config's (%s) '%s' field was %s, but must be one of %s!" % (
+                FileManager.FN_CONFIG, Config.JSON_FIELD_CACHE_STORE, config.cache_store, Cache.STORES.keys()))
+        self.store = Cache.STORES[config.cache_store]()
+
+        # a cache.json of an older daemon is migrated into another store, if that has no cache yet
+        if (self.store.bin_time is None) and (config.cache_store != "json") and os.path.exists(FileManager.FN_CACHE):
+            json_store = JsonCacheStore()
+            if json_store.bin_time is not None:
+                self.store.save(json_store.bin_time, json_store.job_values)
+            os.rename(FileManager.FN_CACHE, FileManager.FN_CACHE + FileManager.SUFFIX_MIGRATED)
+            print "Migrated the cache from %s into the %s store (keeping the former as %s)" % (
+                FileManager.FN_CACHE, config.cache_store, FileManager.FN_CACHE + FileManager.SUFFIX_MIGRATED)
+
+        # a store without a cache starts looking 1h into the past
+        self.first_bin_start_time = self.store.bin_time                 # time (applies to job_values)
+        if self.first_bin_start_time is None:
+            self.first_bin_start_time = int(time.time()) - 60*60*1
+
+        # the store's values of each job looked up so far, or None if it isn't cached
+        self.job_values = {}                                            # {id: (status, {field: val, ...}), ... }
+
+        # load each schedd's history cursor, (re)reading all history in the bins' window if unable
         try:
-            j = FileManager.load_file(FileManager.FN_CACHE)
-            self.first_bin_start_time = j[Cache.JSON_FIELD_BIN_TIME]  # time (applies to job_values)
-            self.job_values = j[Cache.JSON_FIELD_JOB_VALUES]          # {id: (status, {field: val, ...}), ... }
+            j = FileManager.load_file(FileManager.FN_HISTORY_CURSORS)
+            self.history_cursors = j[Cache.JSON_FIELD_CURSORS]        # {schedd name: id, ...}
+
+            # cursors skip jobs which ended before their time, so are invalid if looking further into the past
+            if self.first_bin_start_time < j[Cache.JSON_FIELD_CURSOR_TIME]:
+                self.history_cursors = {}
 
         except IOError:
-            self.first_bin_start_time = int(time.time()) - 60*60*1      # start looking 1h into the past
-            self.job_values = {}
+            self.history_cursors = {}
 
-    @staticmethod
-    def save_time_and_running_values(t, jobs, fields):
+    def save_time_and_running_values(self, t, jobs, fields):
         """
         saves the cache with fields values of active jobs among passed jobs (interpolated to t)
-        from current daemon run, and writes the cache back to file. Currently only correctly handles
+        from current daemon run, and writes the cache back to its store. Currently only correctly handles
         fields which change over time strictly when the job is in the running state (but will accept others blindly)
         """
         values = {}
-        for job in jobs:
+        if (numpy is None) or not fields:
+            for job in jobs:
+                Cache.add_running_values(t, job, fields, values)
+            self.save_time_and_values(t, values)
+            return
+
+        # every cached job's values are interpolated at once
+        cached_jobs = JobList([job for job in jobs if Cache.is_to_be_cached(job)])
+        all_jobvals = [{} for _ in cached_jobs]
+        for field in fields:
+            vals = cached_jobs.table.get_values_when_running_at(field, t).tolist()
+            for jobvals, val in itertools.izip(all_jobvals, vals):
+                jobvals[field] = val
+        for job, jobvals in itertools.izip(cached_jobs, all_jobvals):
+            values[job.id] = (job.status, jobvals)
+        self.save_time_and_values(t, values)
+
+    @staticmethod
+    def is_to_be_cached(job):
+        """returns whether the job's values should be cached (only active jobs which have ever run are)"""
+        return job.is_active() and (Ad.last_run_start_time in job.ad)
 
-            # only active jobs which have ever run are to be cached (to ever be looked at again)
-            if job.is_active() and (Ad.last_run_start_time in job.ad):
-                jobvals = {}
-                for field in fields:
-                    jobvals[field] = job.get_value_when_running_at(field, t)
-                values[job.id] = (job.status, jobvals)
+    @staticmethod
+    def add_running_values(t, job, fields, values):
+        """adds the job's fields values (interpolated to t) to values, if the job should be cached"""
+
+        # only active jobs which have ever run are to be cached (to ever be looked at again)
+        if Cache.is_to_be_cached(job):
+            jobvals = {}
+            for field in fields:
+                jobvals[field] = job.get_value_when_running_at(field, t)
+            values[job.id] = (job.status, jobvals)
+
+    def save_time_and_values(self, t, values):
+        """writes the cache back to its store with values {id: (status, {field: val, ...}), ...} at time t"""
+        self.store.save(t, values)
+
+    @staticmethod
+    def save_history_cursors(t, history_scans, prev_cursors):
+        """
+        advances each schedd's history cursor to the newest job read, beyond which (in the history's newest
+        first order) every read job entered its status no later than t. The next run (with bins starting at t)
+        stops reading the history at the cursor. history_scans is {schedd name: [(id, entered status time),
+        ...], ...} in the order read; schedds absent from it (i.e. which failed) keep their previous cursor
+        """
+        cursors = dict(prev_cursors)
+        for schedd_name in history_scans:
+            cursor = None
+            for job_id, entered_status_time in reversed(history_scans[schedd_name]):
+                if entered_status_time > t:
+                    break
+                cursor = job_id
+            if cursor is not None:
+                cursors[schedd_name] = cursor
 
         obj = {
-            Cache.JSON_FIELD_BIN_TIME: t,
-            Cache.JSON_FIELD_JOB_VALUES: values
+            Cache.JSON_FIELD_CURSOR_TIME: t,
+            Cache.JSON_FIELD_CURSORS: cursors
         }
-        FileManager.write_json_to_file(obj, FileManager.FN_CACHE)
+        FileManager.write_json_to_file(obj, FileManager.FN_HISTORY_CURSORS)
+
+    def forget_values(self, job):
+        """discards the job's values looked up from the store, once the job will no longer be sought"""
+        self.job_values.pop(job.id, None)
 
     def get_prev_running_value_state_and_time(self, job, field):
         """
         get the job's field's previous value, the time of that value and the job's status at it.
         returns (val, status, time)
         """
-        # if in the cache, return info
-        if (job.id in self.job_values) and (field in self.job_values[job.id][1]):
-            return self.job_values[job.id][1][field], self.job_values[job.id][0], self.first_bin_start_time,
+        # if in the cache (looked up from the store when first sought), return info
+        if job.id in self.job_values:
+            cached = self.job_values[job.id]
+        else:
+            cached = self.job_values[job.id] = self.store.get(job.id)
+        if (cached is not None) and (field in cached[1]):
+            return cached[1][field], cached[0], self.first_bin_start_time,
 
         # otherwise we must assume an initial value for the job
         if field in self.initial_values:
@@ -394,6 +1227,215 @@ class Cache(object):
             return val, Job.Status.IDLE, False
 
 
+class TagValues(dict):
+    """
+    a dict of tag field to value, as given by Job.get_values, which remembers its TagDictionary code (or where
+    the code is memoised, before it's first sought) until it's changed
+    """
+
+    __slots__ = ('tag_code', 'tag_memo')
+
+    def _forgetting(method):
+        """wraps a dict method which changes the dict, to forget its code"""
+        def forgetting_method(self, *args, **kwargs):
+            self.tag_code = self.tag_memo = None
+            return method(self, *args, **kwargs)
+        return forgetting_method
+
+    __setitem__ = _forgetting(dict.__setitem__)
+    __delitem__ = _forgetting(dict.__delitem__)
+    update = _forgetting(dict.update)
+    setdefault = _forgetting(dict.setdefault)
+    pop = _forgetting(dict.pop)
+    popitem = _forgetting(dict.popitem)
+    clear = _forgetting(dict.clear)
+
+
+class TagDictionary(object):
+    """
+    interns each distinct set of tag values (for the whole run) as a small integer code, by which bins
+    aggregate their values in place of the tag dicts themselves
+    """
+
+    codes = {}     # {((tag field, val), ...) sorted by field: code}
+    tags = []      # [((tag field, ...), (val, ...)), ...] indexed by code, in the order first interned
+
+    @staticmethod
+    def get_code(tags):
+        """returns the code of the tag dict, interning it if new (and memoising it, if a TagValues)"""
+        memo = getattr(tags, 'tag_memo', None)     # [(tag field, ...), (val, ...), code or None]
+        if memo is None:
+            return TagDictionary.intern(tuple(tags.keys()), tuple(tags.values()))
+        if memo[2] is None:
+            memo[2] = TagDictionary.intern(memo[0], memo[1])
+        tags.tag_code = memo[2]
+        return memo[2]
+
+    @staticmethod
+    def intern(fields, values):
+        """
+        returns the code of the tag values (tuple, in the order of the fields tuple), assigning the next if new.
+        The same tags have the same code whatever the order of their fields
+        """
+        key = tuple(sorted(itertools.izip(fields, values)))
+        code = TagDictionary.codes.get(key)
+        if code is None:
+            code = TagDictionary.codes[key] = len(TagDictionary.tags)
+            TagDictionary.tags.append((fields, values))
+        return code
+
+    @staticmethod
+    def get_tags(code):
+        """returns a new dict of tag field to value of the code"""
+        fields, values = TagDictionary.tags[code]
+        return dict(itertools.izip(fields, values))
+
+
+
+class QuantileSketch(object):
+    """
+    a bounded memory, mergeable summary of a distribution of values (a DDSketch), from which any quantile is
+    estimated within a relative error of relative_accuracy (e.g. 0.01 estimates 200 within [198, 202]). Values
+    are counted in buckets of logarithmically growing width, of which at most BUCKETS_MAX are kept (beyond
+    which the buckets of the smallest magnitudes are combined, losing accuracy only for the smallest values)
+    """
+
+    __slots__ = ('gamma', 'log_gamma', 'positive_counts', 'negative_counts', 'zero_count', 'count')
+
+    # the relative error of estimated quantiles, set by the config before any sketches are made
+    relative_accuracy = 0.01
+
+    # the maximum number of buckets kept of each of the positive and negative values
+    BUCKETS_MAX = 2048
+
+    def __init__(self):
+        self.gamma = (1 + QuantileSketch.relative_accuracy) / (1 - QuantileSketch.relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive_counts = {}   # {bucket index: count, ...}
+        self.negative_counts = {}   # {bucket index of the value's magnitude: count, ...}
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, val):
+        """adds a value to the distribution"""
+        self.count += 1
+        if val == 0:
+            self.zero_count += 1
+            return
+        counts = self.positive_counts if val > 0 else self.negative_counts
+        index = int(math.ceil(math.log(abs(val)) / self.log_gamma))
+        if index in counts:
+            counts[index] += 1
+        else:
+            counts[index] = 1
+            if len(counts) > QuantileSketch.BUCKETS_MAX:
+                QuantileSketch._collapse(counts)
+
+    def merge(self, other):
+        """adds every value of another sketch (of the same accuracy) to this one's distribution"""
+        if other.gamma != self.gamma:
+            raise RuntimeError("QuantileSketch.merge was passed a sketch of a different accuracy " +
+                               "(gamma %s, rather than %s), which can't be merged!" % (other.gamma, self.gamma))
+        for counts, other_counts in [(self.positive_counts, other.positive_counts),
+                                     (self.negative_counts, other.negative_counts)]:
+            for index, count in other_counts.iteritems():
+                if index in counts:
+                    counts[index] += count
+                else:
+                    counts[index] = count
+            if len(counts) > QuantileSketch.BUCKETS_MAX:
+                QuantileSketch._collapse(counts)
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def copy(self):
+        """returns a new sketch of the same distribution"""
+        sketch = QuantileSketch()
+        sketch.merge(self)
+        return sketch
+
+    @staticmethod
+    def _collapse(counts):
+        """combines the buckets of smallest index (magnitude) in counts until only BUCKETS_MAX remain"""
+        indices = sorted(counts)
+        excess = len(indices) - QuantileSketch.BUCKETS_MAX
+        combined = indices[excess]
+        for index in indices[:excess]:
+            counts[combined] += counts.pop(index)
+
+    def get_quantile(self, q):
+        """returns the estimated value at quantile q (in [0, 1]) of the distribution, which mustn't be empty"""
+        rank = q * (self.count - 1)
+
+        # buckets are visited in order of their values, from the most negative to the most positive
+        seen = 0
+        for index in sorted(self.negative_counts, reverse=True):
+            seen += self.negative_counts[index]
+            if seen > rank:
+                return -self._get_bucket_value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+        for index in sorted(self.positive_counts):
+            seen += self.positive_counts[index]
+            if seen > rank:
+                return self._get_bucket_value(index)
+        return self._get_bucket_value(max(self.positive_counts)) if self.positive_counts else 0
+
+    def _get_bucket_value(self, index):
+        """returns the value (of least relative error to all in the bucket) representing the bucket's values"""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+
+class DistinctSketch(object):
+    """
+    a fixed size, mergeable estimate of how many distinct keys have been added (a HyperLogLog), of standard
+    error 1.04 / sqrt(2^PRECISION), so about 2.3% (and within 7% for 99.7% of estimates). Each key's hash
+    picks a register, which keeps the longest run of leading zeros (plus one) seen of the hashes it was picked by
+    """
+
+    __slots__ = ('registers',)
+
+    # the number of hash bits which pick a register, so 2^PRECISION registers (one byte each) are kept
+    PRECISION = 11
+    NUM_REGISTERS = 1 << PRECISION
+    RANK_BITS = 64 - PRECISION
+
+    def __init__(self):
+        self.registers = bytearray(DistinctSketch.NUM_REGISTERS)
+
+    def add(self, key):
+        """adds a key (a string or number, whose hash is the same in every process) to the keys counted"""
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        hashed = int(hashlib.md5(str(key)).hexdigest()[:16], 16)
+        index = hashed >> DistinctSketch.RANK_BITS
+        rank = DistinctSketch.RANK_BITS - (hashed & ((1 << DistinctSketch.RANK_BITS) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """adds the keys counted by another sketch to this one's (so a key in both is still counted once)"""
+        self.registers = bytearray(itertools.imap(max, self.registers, other.registers))
+
+    def copy(self):
+        """returns a new sketch of the same keys"""
+        sketch = DistinctSketch()
+        sketch.registers[:] = self.registers
+        return sketch
+
+    def get_count(self):
+        """returns the estimated number of distinct keys added"""
+        m = DistinctSketch.NUM_REGISTERS
+        estimate = (0.7213 / (1 + 1.079 / m)) * m * m / sum([2.0 ** -rank for rank in self.registers])
+
+        # few keys leave many registers empty, for which counting the empty registers is more accurate
+        num_empty = self.registers.count('\0')
+        if (estimate <= 2.5 * m) and num_empty:
+            estimate = m * math.log(m / float(num_empty))
+        return int(round(estimate))
+
+
 class Bin(object):
     """stores, groups and calculates a metric's values for a specific time bin"""
 
@@ -402,61 +1444,162 @@ class Bin(object):
                  'sum_vals',
                  'job_average_vals',
                  'time_average_vals',
-                 'division_of_sums_vals')
+                 'division_of_sums_vals',
+                 'quantile_vals',
+                 'distinct_vals')
+
+    # each aggregation's stored values and the getter of its results
+    AGGREGATIONS = {'sum': ('sum_vals', 'get_sum'),
+                    'job average': ('job_average_vals', 'get_job_average'),
+                    'time average': ('time_average_vals', 'get_time_average'),
+                    'division of sums': ('division_of_sums_vals', 'get_division_of_sums'),
+                    'quantiles': ('quantile_vals', 'get_quantiles'),
+                    'distinct': ('distinct_vals', 'get_distinct')}
+
+    # the quantiles given by get_quantiles when none are passed
+    DEFAULT_QUANTILES = [0.5, 0.95, 0.99]
 
     def __init__(self, t0, t1):
         self.start_time = t0
         self.end_time = t1
 
-        self.sum_vals = {}               # {tag code: [{tag field: val, ...}, val], ...}
-        self.job_average_vals = {}       # {tag code: [{tag field: val, ...}, val, num jobs], ...}
-        self.time_average_vals = {}      # {tag code: [{tag field: val, ...}, val, total job time], ...}
-        self.division_of_sums_vals = {}  # {tag code: [{tag field: val, ...}, numerator, denominator], ...}
+        # values are grouped by the interned code of their tags (see TagDictionary)
+        self.sum_vals = {}               # {tag code: val, ...}
+        self.job_average_vals = {}       # {tag code: [val, num jobs], ...}
+        self.time_average_vals = {}      # {tag code: [val, total job time], ...}
+        self.division_of_sums_vals = {}  # {tag code: [numerator, denominator], ...}
+        self.quantile_vals = {}          # {tag code: QuantileSketch, ...}
+        self.distinct_vals = {}          # {tag code: DistinctSketch, ...}
 
-    def copy(self):
-        return Bin(self.start_time, self.end_time)
+    @staticmethod
+    def _get_tag_code(tags):
+        """returns the TagDictionary code of the tags, which those given by Job.get_values carry once first sought"""
+        try:
+            return tags.tag_code if (tags.tag_code is not None) else TagDictionary.get_code(tags)
+        except AttributeError:
+            return TagDictionary.get_code(tags)
 
     def add_to_sum(self, val, tags):
 
-        tag_code = '|'.join([tags[key] for key in tags])
+        tag_code = Bin._get_tag_code(tags)
         if tag_code in self.sum_vals:
-            self.sum_vals[tag_code][1] += val
+            self.sum_vals[tag_code] += val
         else:
-            self.sum_vals[tag_code] = [tags, val]
+            self.sum_vals[tag_code] = val
 
     def add_to_job_average(self, val, tags):
 
-        tag_code = '|'.join([tags[key] for key in tags])
+        tag_code = Bin._get_tag_code(tags)
         if tag_code in self.job_average_vals:
-            self.job_average_vals[tag_code][1] += val
-            self.job_average_vals[tag_code][2] += 1
+            item = self.job_average_vals[tag_code]
+            item[0] += val
+            item[1] += 1
         else:
-            self.job_average_vals[tag_code] = [tags, val, 1]
+            self.job_average_vals[tag_code] = [val, 1]
 
     def add_to_time_average(self, val, tags, duration):
 
-        tag_code = '|'.join([tags[key] for key in tags])
+        tag_code = Bin._get_tag_code(tags)
         if tag_code in self.time_average_vals:
-            self.time_average_vals[tag_code][1] += val * duration
-            self.time_average_vals[tag_code][2] += duration
+            item = self.time_average_vals[tag_code]
+            item[0] += val * duration
+            item[1] += duration
         else:
-            self.time_average_vals[tag_code] = [tags, val * duration, duration]
+            self.time_average_vals[tag_code] = [val * duration, duration]
 
     def add_to_division_of_sums(self, num, den, tags):
 
-        tag_code = '|'.join([tags[key] for key in tags])
+        tag_code = Bin._get_tag_code(tags)
         if tag_code in self.division_of_sums_vals:
-            self.division_of_sums_vals[tag_code][1] += num
-            self.division_of_sums_vals[tag_code][2] += den
+            item = self.division_of_sums_vals[tag_code]
+            item[0] += num
+            item[1] += den
         else:
-            self.division_of_sums_vals[tag_code] = [tags, num, den]
+            self.division_of_sums_vals[tag_code] = [num, den]
+
+    def add_to_quantiles(self, val, tags):
+
+        tag_code = Bin._get_tag_code(tags)
+        if tag_code not in self.quantile_vals:
+            self.quantile_vals[tag_code] = QuantileSketch()
+        self.quantile_vals[tag_code].add(val)
+
+    def add_to_distinct(self, key, tags):
+
+        tag_code = Bin._get_tag_code(tags)
+        if tag_code not in self.distinct_vals:
+            self.distinct_vals[tag_code] = DistinctSketch()
+        self.distinct_vals[tag_code].add(key)
+
+    @staticmethod
+    def _reduce_batch(tag_codes, *weights):
+        """
+        returns the distinct tag codes in the array tag_codes, how often each occurs, and a list of the sums of
+        each weights array (or single value, repeated) for each code, all as lists of python numbers. Integer
+        weights keep integer sums
+        """
+        tag_codes = numpy.asarray(tag_codes, dtype=numpy.int64)
+        counts = numpy.bincount(tag_codes)
+        present = numpy.flatnonzero(counts)
+        sums = []
+        for weight in weights:
+            weight = numpy.asarray(weight)
+            if weight.ndim == 0:
+                total = counts[present] * weight
+            else:
+                total = numpy.bincount(tag_codes, weights=weight)[present]
+                if weight.dtype.kind in 'biu':
+                    total = total.astype(numpy.int64)
+            sums.append(total.tolist())
+        return present.tolist(), counts[present].tolist(), sums
+
+    def add_batch_to_sum(self, tag_codes, vals):
+        """
+        adds many values at once (an array, or a single value for every code) to the sums of the corresponding
+        tag codes (an array, e.g. from JobTable.get_tag_codes). Requires NumPy
+        """
+        codes, _, (totals,) = Bin._reduce_batch(tag_codes, vals)
+        for tag_code, total in itertools.izip(codes, totals):
+            if tag_code in self.sum_vals:
+                self.sum_vals[tag_code] += total
+            else:
+                self.sum_vals[tag_code] = total
+
+    def add_batch_to_job_average(self, tag_codes, vals):
+        """adds many values at once to the job averages of the corresponding tag codes (see add_batch_to_sum)"""
+        codes, counts, (totals,) = Bin._reduce_batch(tag_codes, vals)
+        Bin._add_reduced_batch(self.job_average_vals, codes, totals, counts)
+
+    def add_batch_to_time_average(self, tag_codes, vals, durations):
+        """
+        adds many values (each held for the corresponding duration) at once to the time averages of the
+        corresponding tag codes (see add_batch_to_sum)
+        """
+        codes, _, (totals, total_durations) = Bin._reduce_batch(
+            tag_codes, numpy.asarray(vals) * numpy.asarray(durations), durations)
+        Bin._add_reduced_batch(self.time_average_vals, codes, totals, total_durations)
+
+    def add_batch_to_division_of_sums(self, tag_codes, nums, dens):
+        """adds many numerators and denominators at once to the corresponding tag codes (see add_batch_to_sum)"""
+        codes, _, (num_totals, den_totals) = Bin._reduce_batch(tag_codes, nums, dens)
+        Bin._add_reduced_batch(self.division_of_sums_vals, codes, num_totals, den_totals)
+
+    @staticmethod
+    def _add_reduced_batch(vals, codes, firsts, seconds):
+        """adds reduced batch sums to the [first, second] stored values of each code in vals"""
+        for tag_code, first, second in itertools.izip(codes, firsts, seconds):
+            if tag_code in vals:
+                item = vals[tag_code]
+                item[0] += first
+                item[1] += second
+            else:
+                vals[tag_code] = [first, second]
 
     def get_sum(self):
 
         sums = []  # [(vals, {tag field: val, ...}), ... ]
         for tag_code in self.sum_vals:
-            item = self.sum_vals[tag_code]
-            sums.append((item[1], item[0]))
+            sums.append((self.sum_vals[tag_code], TagDictionary.get_tags(tag_code)))
         return sums
 
     def get_job_average(self):
@@ -464,7 +1607,7 @@ class Bin(object):
         averages = []
         for tag_code in self.job_average_vals:
             item = self.job_average_vals[tag_code]
-            averages.append((item[1] / float(item[2]), item[0]))
+            averages.append((item[0] / float(item[1]), TagDictionary.get_tags(tag_code)))
         return averages
 
     def get_time_average(self):
@@ -472,7 +1615,7 @@ class Bin(object):
         averages = []
         for tag_code in self.time_average_vals:
             item = self.time_average_vals[tag_code]
-            averages.append((item[1] / float(item[2]), item[0]))
+            averages.append((item[0] / float(item[1]), TagDictionary.get_tags(tag_code)))
         return averages
 
     def get_division_of_sums(self):
@@ -480,9 +1623,79 @@ class Bin(object):
         divisions = []
         for tag_code in self.division_of_sums_vals:
             item = self.division_of_sums_vals[tag_code]
-            divisions.append((item[1] / float(item[2]), item[0]))
+            divisions.append((item[0] / float(item[1]), TagDictionary.get_tags(tag_code)))
         return divisions
 
+    def get_quantiles(self, qs=None):
+        """
+        returns the estimated quantiles (each in [0, 1]) of each tag's values as a dict of field name (e.g. p95
+        for 0.95) to value, each becoming a field in influx. qs defaults to DEFAULT_QUANTILES
+        """
+        if qs is None:
+            qs = Bin.DEFAULT_QUANTILES
+
+        quantiles = []
+        names = ['p%g' % (q * 100) for q in qs]
+        for tag_code in self.quantile_vals:
+            sketch = self.quantile_vals[tag_code]
+            vals = dict([(name, sketch.get_quantile(q)) for name, q in itertools.izip(names, qs)])
+            quantiles.append((vals, TagDictionary.get_tags(tag_code)))
+        return quantiles
+
+    def get_distinct(self):
+        """returns the estimated number of distinct keys added with each tag (see DistinctSketch for its error)"""
+        counts = []
+        for tag_code in self.distinct_vals:
+            counts.append((self.distinct_vals[tag_code].get_count(), TagDictionary.get_tags(tag_code)))
+        return counts
+
+
+
+class BinIndex(object):
+    """
+    maps time spans to the range of (contiguous, equal duration) time bins they overlap by arithmetic, so that
+    each job need only be considered at the bins its span covers, rather than at every bin
+    """
+
+    def __init__(self, bin_times, bin_duration):
+        """requires the start times of the bins (each bin_duration long and ascending)"""
+        self.first_bin_start_time = bin_times[0] if bin_times else 0
+        self.num_bins = len(bin_times)
+        self.bin_duration = bin_duration
+
+    def get_bin_range(self, t0, t1):
+        """
+        returns (first, last) indices of the bins overlapped by the span [t0, t1], where t1 is False if the
+        span hasn't ended. A bin is overlapped as per Job.is_running_during (the span doesn't end before or
+        start after it). Returns None if no bins are overlapped
+        """
+        first = max(0, (t0 - self.first_bin_start_time) // self.bin_duration)
+        if t1:
+            last = min(self.num_bins - 1, -((self.first_bin_start_time - t1) // self.bin_duration) - 1)
+        else:
+            last = self.num_bins - 1
+        return (first, last) if first <= last else None
+
+    def iter_jobs_by_bin(self, jobs, get_span):
+        """
+        yields, for each bin in order, a list of the jobs whose span (given by get_span(job), in the format of
+        Job.get_most_recent_time_span_running) overlaps it. Jobs are swept in order of their first bin, and
+        dropped after their last, so each is only handled at the bins it covers
+        """
+        starting = [[] for _ in range(self.num_bins)]
+        for job in jobs:
+            t0, t1 = get_span(job)
+
+            # a span start of False means the job has never been in the state
+            bin_range = self.get_bin_range(t0, t1) if t0 else None
+            if bin_range is not None:
+                starting[bin_range[0]].append((bin_range[1], job))
+
+        active = []
+        for index in range(self.num_bins):
+            active = [entry for entry in active if entry[0] >= index] + starting[index]
+            yield [job for _, job in active]
+
 
 class Job(object):
     """A single Condor job container"""
@@ -534,7 +1747,15 @@ class Job(object):
                  'last_run_start_time',
                  'last_suspend_time',
                  'last_evict_time',
-                 'completion_date')
+                 'completion_date',
+
+                 '_idle_span',
+                 '_running_span',
+                 '_values')
+
+    # how often (across all jobs) memoised spans and values were reused, rather than recalculated. Only counted
+    # in debug mode (which alone reports them), as the counts are shared by every job of every thread
+    memo_stats = {'span hits': 0, 'span misses': 0, 'value hits': 0, 'value misses': 0}
 
     def __init__(self, ad, cache, config):
         """requires the job's condor classad, and handles to the global job cache and the config"""
@@ -560,6 +1781,28 @@ class Job(object):
         # fix the shitty bad condor fields
         self.fix_ad()
 
+        # spans and values are memoised for the rest of the run
+        self.invalidate_memos()
+
+    def invalidate_memos(self):
+        """
+        forgets the job's memoised time spans and values, which must be done if its ad or state fields
+        are changed after any were first sought
+        """
+        self._idle_span = None
+        self._running_span = None
+        self._values = {}     # {(field, ...): [(field, ...), (val, ...), tag code or None], ...}
+
+    @staticmethod
+    def get_memo_report():
+        """returns a string reporting the hit rates of all jobs' memoised spans and values (see memo_stats)"""
+        report = []
+        for kind in ['span', 'value']:
+            hits = Job.memo_stats['%s hits' % kind]
+            total = hits + Job.memo_stats['%s misses' % kind]
+            report.append("%s hits: %s of %s (%.1f%%)" % (kind, hits, total, (100.0*hits/total) if total else 0))
+        return ', '.join(report)
+
     def fix_ad(self):
         """
         tinkers with some job classad fields which condor leaves invalid or problematic
@@ -585,6 +1828,25 @@ class Job(object):
         returns a dict of field name to the job's current value for all the passed fields.
         fields can be condor classad fields (which MUST be in the job's ad) or a MockAd
         """
+        key = tuple(fields)
+        if key in self._values:
+            if DEBUG_PRINT:
+                Job.memo_stats['value hits'] += 1
+            memo = self._values[key]
+        else:
+            if DEBUG_PRINT:
+                Job.memo_stats['value misses'] += 1
+            values = self._get_values(fields)
+            memo = self._values[key] = [key, tuple([values[field] for field in key]), None]
+
+        # the values' tag code is memoised too, once a bin first seeks it
+        tags = TagValues(zip(key, memo[1]))
+        tags.tag_code = memo[2]
+        tags.tag_memo = memo
+        return tags
+
+    def _get_values(self, fields):
+        """returns a dict of field name to the job's current value for all the passed fields (see get_values)"""
         values = {}
         for field in fields:
 
@@ -669,6 +1931,18 @@ class Job(object):
         returns the time span  (start, end) of job's most recent idle state
         (if still idle, span end is False)
         """
+        if self._idle_span is not None:
+            if DEBUG_PRINT:
+                Job.memo_stats['span hits'] += 1
+            return self._idle_span
+
+        if DEBUG_PRINT:
+            Job.memo_stats['span misses'] += 1
+        self._idle_span = self._get_most_recent_time_span_idle()
+        return self._idle_span
+
+    def _get_most_recent_time_span_idle(self):
+        """returns the time span (start, end) of job's most recent idle state (see get_most_recent_time_span_idle)"""
         # if currently idle, it's been so since status change!
         if self.is_idle():
             entered = self.entered_status_time
@@ -705,6 +1979,21 @@ class Job(object):
         returns the time span of the job's most recent running state in format (start, end).
         start will be False if never run. end will be False if still running (and start not False)
         """
+        if self._running_span is not None:
+            if DEBUG_PRINT:
+                Job.memo_stats['span hits'] += 1
+            return self._running_span
+
+        if DEBUG_PRINT:
+            Job.memo_stats['span misses'] += 1
+        self._running_span = self._get_most_recent_time_span_running()
+        return self._running_span
+
+    def _get_most_recent_time_span_running(self):
+        """
+        returns the time span of the job's most recent running state in format (start, end)
+        (see get_most_recent_time_span_running)
+        """
         # if currently running, it's been so since status change!
         if self.is_running():
             entered = self.last_run_start_time
@@ -793,6 +2082,32 @@ class Job(object):
         # running during [t0, t1] if it ever ran (r0 not False) and doesn't end before or start after
         return r0 and not (r0 >= t1 or r1 <= t0)
 
+    def get_bins_idle_during(self, bins):
+        """
+        returns the sublist of bins (contiguous, equal duration Bin instances, as passed to a metric's
+        calculate_over_bins) in which the job was idle, as per is_idle_during
+        """
+        return Job._get_bins_during(bins, self.get_most_recent_time_span_idle())
+
+    def get_bins_running_during(self, bins):
+        """
+        returns the sublist of bins (contiguous, equal duration Bin instances, as passed to a metric's
+        calculate_over_bins) in which the job was running, as per is_running_during
+        """
+        return Job._get_bins_during(bins, self.get_most_recent_time_span_running())
+
+    @staticmethod
+    def _get_bins_during(bins, span):
+        """returns the sublist of bins which the span (start, end) overlaps, finding them by arithmetic"""
+        t0, t1 = span
+
+        # a span start of False means the job has never been in the state
+        if not (bins and t0):
+            return []
+        duration = bins[0].end_time - bins[0].start_time
+        bin_range = BinIndex(xrange(bins[0].start_time, bins[-1].end_time, duration), duration).get_bin_range(t0, t1)
+        return bins[bin_range[0]: bin_range[1] + 1] if bin_range else []
+
     def get_time_idle_in(self, t0, t1):
         """returns the duration (seconds) for which the job is idle within times t0 and t1"""
         # i1 is False if the job is still ide
@@ -833,7 +2148,8 @@ class Job(object):
         # find the total time for which the job was running since last known value
         dt = self.get_time_running_in(prev_time, self.server_time)
 
-        return (self.ad[field] - prev_val)/float(dt) if (dt > 0) else 0
+        # a job whose ad lacks the field (e.g. condor hasn't yet reported it) hasn't changed from the known value
+        return (self.ad.get(field, prev_val) - prev_val)/float(dt) if (dt > 0) else 0
 
     # TODO: this is currently ONLY for fields which update strictly during when the job is RUNNING (e.g. cpu time)
     def get_change_in_value_when_running_over(self, field, t0, t1):
@@ -862,6 +2178,312 @@ class Job(object):
         return prev_val + dv
 
 
+class JobTable(object):
+    """
+    stores the state fields of many jobs as columns (NumPy arrays), so that their most recent time spans and
+    their states within many time bins can be evaluated for every job at once. A missing (None) field is
+    stored as 0, which Job's methods treat identically (e.g. a span end of 0 means the state hasn't ended)
+    """
+
+    def __init__(self, jobs):
+        """requires a list of Job instances (whose order the rows of every column and result follow)"""
+        if numpy is None:
+            raise RuntimeError("A JobTable was requested but NumPy isn't installed! Install NumPy (e.g. " +
+                               "pip install numpy) to use the daemon's vectorized job evaluation.")
+
+        self.jobs = jobs
+
+        def column(attr):
+            return numpy.array([getattr(job, attr) or 0 for job in jobs], dtype=numpy.int64)
+
+        self.status = column('status')
+        self.prev_status = column('prev_status')
+        self.queue_time = column('queue_time')
+        self.entered_status_time = column('entered_status_time')
+        self.server_time = column('server_time')
+        self.last_run_start_time = column('last_run_start_time')
+        self.last_evict_time = column('last_evict_time')
+        self.last_suspend_time = column('last_suspend_time')
+        self.completion_date = column('completion_date')
+
+        self._running_spans = None
+        self._idle_spans = None
+        self._tag_codes = {}    # {(tag field, ...): codes}
+        self._values = {}       # {field: vals}
+        self._prev_values = {}  # {field: (prev vals, prev times, vals)}
+        self._rates = {}        # {field: rates}
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def get_tag_codes(self, fields):
+        """
+        returns an array of each job's TagDictionary code of its values of the fields (e.g. a metric's tags), as
+        accepted by the Bin batch methods
+        """
+        if tuple(fields) not in self._tag_codes:
+            self._tag_codes[tuple(fields)] = numpy.array(
+                [TagDictionary.get_code(job.get_values(fields)) for job in self.jobs], dtype=numpy.int64)
+        return self._tag_codes[tuple(fields)]
+
+    def get_values(self, field):
+        """returns an array of each job's (numeric) value of the field (or mock ad), as per Job.get_values"""
+        if field not in self._values:
+            self._values[field] = numpy.array([job._get_values([field])[field] for job in self.jobs], dtype=float)
+        return self._values[field]
+
+    def get_most_recent_time_spans_idle(self):
+        """
+        returns arrays (starts, ends) of every job's most recent idle state, as per
+        Job.get_most_recent_time_span_idle (an end of 0 means the job is still idle)
+        """
+        if self._idle_spans is not None:
+            return self._idle_spans
+
+        is_idle = self.status == Job.Status.IDLE
+        was_idle = self.prev_status == Job.Status.IDLE
+        was_running = self.prev_status == Job.Status.RUNNING
+
+        # unless currently idle, it entered at queue or when evicted or suspended
+        requeued = numpy.maximum(self.queue_time, numpy.maximum(self.last_evict_time, self.last_suspend_time))
+        starts = numpy.where(is_idle, self.entered_status_time, requeued)
+
+        # if previously idle it ended at the status change, if just running it ended when that started,
+        # otherwise we have no idea!
+        ends = numpy.select([is_idle, was_idle, was_running],
+                            [0, self.entered_status_time, self.last_run_start_time],
+                            starts + 1)
+
+        # error checking
+        unknown = ~is_idle & ~was_idle & was_running & (self.last_run_start_time == 0)
+        if unknown.any():
+            job = self.jobs[numpy.flatnonzero(unknown)[0]]
+            raise ValueError("get_most_recent_time_spans_idle found a job for which we couldn't determine " +
+                             "when the idle state ended!\n" +
+                             "status: %s, prev status: %s" % (job.status, job.prev_status))
+
+        self._idle_spans = starts, ends
+        return self._idle_spans
+
+    def get_most_recent_time_spans_running(self):
+        """
+        returns arrays (starts, ends) of every job's most recent running state, as per
+        Job.get_most_recent_time_span_running (a start of 0 means the job has never run, and an end of
+        0 means it's still running)
+        """
+        if self._running_spans is not None:
+            return self._running_spans
+
+        started = self.last_run_start_time
+        has_run = started != 0
+
+        # a job running then suspended, held or evicted ended at the earliest of those after it started,
+        # else we've lost it and must claim it stopped instantly
+        evicted_after = self.last_evict_time > started
+        suspended_after = self.last_suspend_time > started
+        interrupted = numpy.select(
+            [evicted_after & suspended_after, evicted_after, suspended_after],
+            [numpy.minimum(self.last_evict_time, self.last_suspend_time), self.last_evict_time,
+             self.last_suspend_time],
+            started + 1)
+
+        # conditions are in order of precedence, as in Job.get_most_recent_time_span_running
+        is_running = self.status == Job.Status.RUNNING
+        was_running = self.prev_status == Job.Status.RUNNING
+        ended_at_status_change = ((self.status == Job.Status.TRANSFERRING_OUTPUT) |
+                                  (self.status == Job.Status.REMOVED))
+        ends = numpy.select(
+            [is_running, was_running, ~has_run, self.status == Job.Status.COMPLETED, ended_at_status_change],
+            [0, self.entered_status_time, 0, self.completion_date, self.entered_status_time],
+            interrupted)
+
+        self._running_spans = started, ends
+        return self._running_spans
+
+    @staticmethod
+    def _as_bin_bounds(t0s, t1s):
+        """formats bin start and end times as row vectors (to broadcast against job columns)"""
+        return (numpy.asarray(t0s, dtype=numpy.int64).reshape(1, -1),
+                numpy.asarray(t1s, dtype=numpy.int64).reshape(1, -1))
+
+    def is_idle_during(self, t0s, t1s):
+        """
+        returns a (jobs x bins) boolean array of whether each job was idle for any time in each bin, with
+        bins [t0s[i], t1s[i]], as per Job.is_idle_during
+        """
+        t0s, t1s = JobTable._as_bin_bounds(t0s, t1s)
+        i0, i1 = [span.reshape(-1, 1) for span in self.get_most_recent_time_spans_idle()]
+        i1 = numpy.where(i1 != 0, i1, t1s)
+        return ~((i0 >= t1s) | (i1 <= t0s))
+
+    def is_running_during(self, t0s, t1s):
+        """
+        returns a (jobs x bins) boolean array of whether each job was running for any time in each bin, with
+        bins [t0s[i], t1s[i]], as per Job.is_running_during
+        """
+        t0s, t1s = JobTable._as_bin_bounds(t0s, t1s)
+        r0, r1 = [span.reshape(-1, 1) for span in self.get_most_recent_time_spans_running()]
+        r1 = numpy.where(r1 != 0, r1, t1s)
+        return (r0 != 0) & ~((r0 >= t1s) | (r1 <= t0s))
+
+    def get_time_idle_in(self, t0s, t1s):
+        """
+        returns a (jobs x bins) array of the duration each job was idle within each bin, with bins
+        [t0s[i], t1s[i]], as per Job.get_time_idle_in
+        """
+        t0s, t1s = JobTable._as_bin_bounds(t0s, t1s)
+        i0, i1 = [span.reshape(-1, 1) for span in self.get_most_recent_time_spans_idle()]
+        i1 = numpy.where(i1 != 0, i1, t1s)
+        return numpy.maximum(numpy.minimum(t1s, i1) - numpy.maximum(t0s, i0), 0)
+
+    def get_time_running_in(self, t0s, t1s):
+        """
+        returns a (jobs x bins) array of the duration each job was running within each bin, with bins
+        [t0s[i], t1s[i]], as per Job.get_time_running_in
+        """
+        t0s, t1s = JobTable._as_bin_bounds(t0s, t1s)
+        r0, r1 = [span.reshape(-1, 1) for span in self.get_most_recent_time_spans_running()]
+        r1 = numpy.where(r1 != 0, r1, t1s)
+        dt = numpy.maximum(numpy.minimum(t1s, r1) - numpy.maximum(t0s, r0), 0)
+        return numpy.where(r0 != 0, dt, 0)
+
+    def _get_time_running_within(self, t0s, t1s):
+        """
+        returns an array of the duration each job was running within its own span [t0s[j], t1s[j]] (arrays, or
+        a single time for every job), as per Job.get_time_running_in
+        """
+        r0, r1 = self.get_most_recent_time_spans_running()
+        r1 = numpy.where(r1 != 0, r1, t1s)
+        dt = numpy.maximum(numpy.minimum(t1s, r1) - numpy.maximum(t0s, r0), 0)
+        return numpy.where(r0 != 0, dt, 0)
+
+    def _get_prev_running_values_and_times(self, field):
+        """
+        returns arrays of each job's previous value of the field and the time of it (0 for False), from the
+        cache as per Job.get_rate_of_change_of_value_when_running, and of its current value (0 if it has no
+        previous time, or the previous value if its ad lacks the field)
+        """
+        if field not in self._prev_values:
+            prev_vals, prev_times, vals = [], [], []
+            for job in self.jobs:
+                prev_val, _, prev_time = job.cache.get_prev_running_value_state_and_time(job, field)
+                prev_vals.append(prev_val)
+                prev_times.append(prev_time or 0)
+                vals.append(job.ad.get(field, prev_val) if prev_time else 0)
+            self._prev_values[field] = (numpy.array(prev_vals, dtype=float),
+                                        numpy.array(prev_times, dtype=numpy.int64), numpy.array(vals, dtype=float))
+        return self._prev_values[field]
+
+    def get_rates_of_change_of_value_when_running(self, field):
+        """
+        returns an array of the rate of change of each job's value of the field while running, as per
+        Job.get_rate_of_change_of_value_when_running, found from the cache's previous values in one step
+        """
+        if field not in self._rates:
+            prev_vals, prev_times, vals = self._get_prev_running_values_and_times(field)
+            dt = self._get_time_running_within(prev_times, self.server_time)
+            ok = (prev_times != 0) & (dt > 0)
+            self._rates[field] = numpy.where(ok, (vals - prev_vals) / numpy.where(ok, dt, 1), 0.)
+        return self._rates[field]
+
+    def get_changes_in_value_when_running_over(self, field, t0s, t1s):
+        """
+        returns a (jobs x bins) array of the change in each job's value of the field within each bin, with bins
+        [t0s[i], t1s[i]], as per Job.get_change_in_value_when_running_over
+        """
+        rates = self.get_rates_of_change_of_value_when_running(field).reshape(-1, 1)
+        return rates * self.get_time_running_in(t0s, t1s)
+
+    def get_values_when_running_at(self, field, t):
+        """
+        returns an array of each job's value of the field at time t, linearly interpolated from the cache's
+        previous value, as per Job.get_value_when_running_at
+        """
+        prev_vals, prev_times, _ = self._get_prev_running_values_and_times(field)
+        changes = self.get_rates_of_change_of_value_when_running(field) * self._get_time_running_within(prev_times, t)
+        return numpy.where(prev_times != 0, prev_vals + changes, prev_vals)
+
+
+class JobList(list):
+    """a list of Job instances, which (lazily) provides them as a JobTable for vectorized evaluation"""
+
+    def __init__(self, jobs=()):
+        list.__init__(self, jobs)
+        self._table = None
+
+    @property
+    def table(self):
+        """the jobs as a JobTable (built once, so the list musn't be changed after it's first accessed)"""
+        if self._table is None:
+            self._table = JobTable(self)
+        return self._table
+
+    def clear(self):
+        """empties the list, discarding its table"""
+        del self[:]
+        self._table = None
+
+
+class FieldIndex(object):
+    """
+    records which of a list of jobs contain each field (or mock ad) as a bitmap (an int whose i-th bit is set
+    if the i-th job does), built in one pass over the jobs, so that the jobs containing all the fields a metric
+    needs are found by AND-ing bitmaps, rather than by seeking (and failing to get) each job's values
+    """
+
+    def __init__(self, jobs, fields):
+        """requires the jobs to index and the fields to index up front (others are indexed when first sought)"""
+        self.jobs = jobs
+        self.all_jobs = (1 << len(jobs)) - 1
+        self.bitmaps = {}
+
+        # every field's bits are gathered in the one pass
+        fields = [field for field in set(fields)]
+        all_bits = [[] for _ in fields]
+        for job in jobs:
+            for field, bits in itertools.izip(fields, all_bits):
+                bits.append('1' if FieldIndex.has_field(job, field) else '0')
+
+        # the first job is the lowest bit, so the bits are reversed
+        for field, bits in itertools.izip(fields, all_bits):
+            self.bitmaps[field] = int(''.join(reversed(bits)), 2) if bits else 0
+
+    @staticmethod
+    def has_field(job, field):
+        """returns whether the job contains the field, or what the mock ad is found from (see Job.get_values)"""
+        if field == MockAd.batch_job_site:
+            return (Ad.last_remote_host in job.ad) or (Ad.remote_host in job.ad)
+        return field in job.ad
+
+    @staticmethod
+    def has_fields(job, fields):
+        """returns whether the job contains all of the fields"""
+        for field in fields:
+            if not FieldIndex.has_field(job, field):
+                return False
+        return True
+
+    def get_bitmap(self, fields):
+        """returns the bitmap of the jobs which contain all of the fields"""
+        bitmap = self.all_jobs
+        for field in fields:
+            if field not in self.bitmaps:
+                self.bitmaps[field] = FieldIndex(self.jobs, [field]).bitmaps[field]
+            bitmap &= self.bitmaps[field]
+        return bitmap
+
+    def get_jobs(self, bitmap):
+        """returns a JobList of the jobs whose bits are set in the bitmap (in their original order)"""
+        if bitmap == self.all_jobs:
+            return JobList(self.jobs)
+        return JobList([job for job, bit in itertools.izip(self.jobs, bin(bitmap)[:1:-1]) if bit == '1'])
+
+    @staticmethod
+    def count(bitmap):
+        """returns the number of jobs whose bits are set in the bitmap"""
+        return bin(bitmap).count('1')
+
+
 class Config(object):
     """loads and provides access to configurable daemon settings"""
 
@@ -895,6 +2517,55 @@ class Config(object):
     JSON_FIELD_INFLUX_PASSWORD = "INFLUX PASSWORD"
     JSON_VALUE_INFLUX_PASSWORD_DEFAULT = "(this isn't the real password)"
 
+    # schedds are queried concurrently by a bounded pool of workers, each schedd given a timeout (seconds)
+    JSON_FIELD_SCHEDD_QUERY_WORKERS = "SCHEDD QUERY WORKERS"
+    JSON_VALUE_SCHEDD_QUERY_WORKERS_DEFAULT = 8
+    JSON_FIELD_SCHEDD_QUERY_TIMEOUT = "SCHEDD QUERY TIMEOUT"
+    JSON_VALUE_SCHEDD_QUERY_TIMEOUT_DEFAULT = 5*60
+
+    # whether to continue with the jobs of the remaining schedds when some fail or time out (else the run aborts)
+    JSON_FIELD_ALLOW_PARTIAL_SCHEDD_RESULTS = "ALLOW PARTIAL SCHEDD RESULTS"
+    JSON_VALUE_ALLOW_PARTIAL_SCHEDD_RESULTS_DEFAULT = False
+
+    # whether jobs are streamed from the schedds straight into the metrics' bins, rather than collected first
+    JSON_FIELD_STREAM_JOBS = "STREAM JOBS"
+    JSON_VALUE_STREAM_JOBS_DEFAULT = False
+
+    # the relative error of quantiles estimated by Bin.get_quantiles (smaller costs more memory per sketch)
+    JSON_FIELD_QUANTILE_ACCURACY = "QUANTILE ACCURACY"
+    JSON_VALUE_QUANTILE_ACCURACY_DEFAULT = 0.01
+
+    # the store of the cache (one of Cache.STORES), into which a cache of another store isn't migrated (except json)
+    # ("sqlite" saves only the values which changed; "log" appends only each run's changes to a snapshot)
+    JSON_FIELD_CACHE_STORE = "CACHE STORE"
+    JSON_VALUE_CACHE_STORE_DEFAULT = "sqlite"
+
+    # the gzip level (1-9, or 0 to send uncompressed) of bodies written to influx, and the size (in bytes) below
+    # which a body isn't worth compressing
+    JSON_FIELD_WRITE_COMPRESSION_LEVEL = "WRITE COMPRESSION LEVEL"
+    JSON_VALUE_WRITE_COMPRESSION_LEVEL_DEFAULT = 0
+    JSON_FIELD_WRITE_COMPRESSION_MIN_BYTES = "WRITE COMPRESSION MIN BYTES"
+    JSON_VALUE_WRITE_COMPRESSION_MIN_BYTES_DEFAULT = 1024
+
+    # the size (in bytes, before compression) of each body written to influx (lines are batched up to it), and the
+    # number of writes to a database which may be in flight at once
+    JSON_FIELD_WRITE_BATCH_BYTES = "WRITE BATCH BYTES"
+    JSON_VALUE_WRITE_BATCH_BYTES_DEFAULT = 2*1024*1024
+    JSON_FIELD_WRITE_WORKERS_PER_DATABASE = "WRITE WORKERS PER DATABASE"
+    JSON_VALUE_WRITE_WORKERS_PER_DATABASE_DEFAULT = 4
+
+    # the most bytes of lines the outbox may hold on disk, beyond which its oldest segments are dropped
+    JSON_FIELD_OUTBOX_MAX_BYTES = "OUTBOX MAX BYTES"
+    JSON_VALUE_OUTBOX_MAX_BYTES_DEFAULT = 256*1024*1024
+
+    # seconds for which a database, once created, is assumed to exist (so isn't created again before each push)
+    JSON_FIELD_KNOWN_DATABASE_TTL = "KNOWN DATABASE TTL"
+    JSON_VALUE_KNOWN_DATABASE_TTL_DEFAULT = 24*60*60
+
+    # seconds for which a connection to influx (or its proxy) may wait to connect, or for each read, before failing
+    JSON_FIELD_INFLUX_TIMEOUT = "INFLUX TIMEOUT"
+    JSON_VALUE_INFLUX_TIMEOUT_DEFAULT = 60
+
     def __init__(self):
 
         # initial_values give a field's initial value in a job,
@@ -913,6 +2584,31 @@ class Config(object):
             self.influx_username = j[Config.JSON_FIELD_INFLUX_USERNAME]
             self.influx_password = j[Config.JSON_FIELD_INFLUX_PASSWORD]
 
+            # fields added after the original config format default when absent
+            self.schedd_query_workers = j.get(Config.JSON_FIELD_SCHEDD_QUERY_WORKERS,
+                                              Config.JSON_VALUE_SCHEDD_QUERY_WORKERS_DEFAULT)
+            self.schedd_query_timeout = j.get(Config.JSON_FIELD_SCHEDD_QUERY_TIMEOUT,
+                                              Config.JSON_VALUE_SCHEDD_QUERY_TIMEOUT_DEFAULT)
+            self.allow_partial_schedd_results = j.get(Config.JSON_FIELD_ALLOW_PARTIAL_SCHEDD_RESULTS,
+                                                      Config.JSON_VALUE_ALLOW_PARTIAL_SCHEDD_RESULTS_DEFAULT)
+            self.stream_jobs = j.get(Config.JSON_FIELD_STREAM_JOBS, Config.JSON_VALUE_STREAM_JOBS_DEFAULT)
+            self.quantile_accuracy = j.get(Config.JSON_FIELD_QUANTILE_ACCURACY,
+                                           Config.JSON_VALUE_QUANTILE_ACCURACY_DEFAULT)
+            self.cache_store = j.get(Config.JSON_FIELD_CACHE_STORE, Config.JSON_VALUE_CACHE_STORE_DEFAULT)
+            self.write_compression_level = j.get(Config.JSON_FIELD_WRITE_COMPRESSION_LEVEL,
+                                                 Config.JSON_VALUE_WRITE_COMPRESSION_LEVEL_DEFAULT)
+            self.write_compression_min_bytes = j.get(Config.JSON_FIELD_WRITE_COMPRESSION_MIN_BYTES,
+                                                     Config.JSON_VALUE_WRITE_COMPRESSION_MIN_BYTES_DEFAULT)
+            self.write_batch_bytes = j.get(Config.JSON_FIELD_WRITE_BATCH_BYTES,
+                                           Config.JSON_VALUE_WRITE_BATCH_BYTES_DEFAULT)
+            self.write_workers_per_database = j.get(Config.JSON_FIELD_WRITE_WORKERS_PER_DATABASE,
+                                                    Config.JSON_VALUE_WRITE_WORKERS_PER_DATABASE_DEFAULT)
+            self.outbox_max_bytes = j.get(Config.JSON_FIELD_OUTBOX_MAX_BYTES,
+                                          Config.JSON_VALUE_OUTBOX_MAX_BYTES_DEFAULT)
+            self.known_database_ttl = j.get(Config.JSON_FIELD_KNOWN_DATABASE_TTL,
+                                            Config.JSON_VALUE_KNOWN_DATABASE_TTL_DEFAULT)
+            self.influx_timeout = j.get(Config.JSON_FIELD_INFLUX_TIMEOUT, Config.JSON_VALUE_INFLUX_TIMEOUT_DEFAULT)
+
         except IOError:
             self.bin_duration = Config.JSON_VALUE_BIN_DURATION_DEFAULT
             self.database_url = Config.JSON_VALUE_DATABASE_URL_EMPTY
@@ -922,6 +2618,19 @@ class Config(object):
             self.node_renames = Config.JSON_VALUE_BATCH_JOB_SITE_NAME_MAP_DEFAULT
             self.influx_username = Config.JSON_VALUE_INFLUX_USERNAME_DEFAULT
             self.influx_password = Config.JSON_VALUE_INFLUX_PASSWORD_DEFAULT
+            self.schedd_query_workers = Config.JSON_VALUE_SCHEDD_QUERY_WORKERS_DEFAULT
+            self.schedd_query_timeout = Config.JSON_VALUE_SCHEDD_QUERY_TIMEOUT_DEFAULT
+            self.allow_partial_schedd_results = Config.JSON_VALUE_ALLOW_PARTIAL_SCHEDD_RESULTS_DEFAULT
+            self.stream_jobs = Config.JSON_VALUE_STREAM_JOBS_DEFAULT
+            self.quantile_accuracy = Config.JSON_VALUE_QUANTILE_ACCURACY_DEFAULT
+            self.cache_store = Config.JSON_VALUE_CACHE_STORE_DEFAULT
+            self.write_compression_level = Config.JSON_VALUE_WRITE_COMPRESSION_LEVEL_DEFAULT
+            self.write_compression_min_bytes = Config.JSON_VALUE_WRITE_COMPRESSION_MIN_BYTES_DEFAULT
+            self.write_batch_bytes = Config.JSON_VALUE_WRITE_BATCH_BYTES_DEFAULT
+            self.write_workers_per_database = Config.JSON_VALUE_WRITE_WORKERS_PER_DATABASE_DEFAULT
+            self.outbox_max_bytes = Config.JSON_VALUE_OUTBOX_MAX_BYTES_DEFAULT
+            self.known_database_ttl = Config.JSON_VALUE_KNOWN_DATABASE_TTL_DEFAULT
+            self.influx_timeout = Config.JSON_VALUE_INFLUX_TIMEOUT_DEFAULT
             obj = {
                 Config.JSON_FIELD_BIN_DURATION: self.bin_duration,
                 Config.JSON_FIELD_DATABASE_URL: self.database_url,
@@ -930,7 +2639,20 @@ class Config(object):
                 Config.JSON_FIELD_JOB_CONSTRAINT: self.constraint,
                 Config.JSON_FIELD_BATCH_JOB_SITE_NAME_MAP: self.node_renames,
                 Config.JSON_FIELD_INFLUX_USERNAME: self.influx_username,
-                Config.JSON_FIELD_INFLUX_PASSWORD: self.influx_password
+                Config.JSON_FIELD_INFLUX_PASSWORD: self.influx_password,
+                Config.JSON_FIELD_SCHEDD_QUERY_WORKERS: self.schedd_query_workers,
+                Config.JSON_FIELD_SCHEDD_QUERY_TIMEOUT: self.schedd_query_timeout,
+                Config.JSON_FIELD_ALLOW_PARTIAL_SCHEDD_RESULTS: self.allow_partial_schedd_results,
+                Config.JSON_FIELD_STREAM_JOBS: self.stream_jobs,
+                Config.JSON_FIELD_QUANTILE_ACCURACY: self.quantile_accuracy,
+                Config.JSON_FIELD_CACHE_STORE: self.cache_store,
+                Config.JSON_FIELD_WRITE_COMPRESSION_LEVEL: self.write_compression_level,
+                Config.JSON_FIELD_WRITE_COMPRESSION_MIN_BYTES: self.write_compression_min_bytes,
+                Config.JSON_FIELD_WRITE_BATCH_BYTES: self.write_batch_bytes,
+                Config.JSON_FIELD_WRITE_WORKERS_PER_DATABASE: self.write_workers_per_database,
+                Config.JSON_FIELD_OUTBOX_MAX_BYTES: self.outbox_max_bytes,
+                Config.JSON_FIELD_KNOWN_DATABASE_TTL: self.known_database_ttl,
+                Config.JSON_FIELD_INFLUX_TIMEOUT: self.influx_timeout
             }
             FileManager.write_json_to_file(obj, FileManager.FN_CONFIG)
 
@@ -954,6 +2676,9 @@ class Config(object):
 
 class Condor(object):
 
+    # maximum number of queried schedds whose streamed jobs are waiting (received but not yet consumed) at any time
+    STREAM_QUEUE_MAX = 1
+
     def __init__(self, config):
 
         addr = config.collector_address
@@ -971,6 +2696,9 @@ class Condor(object):
         self.constraint = config.constraint
         self.current_time = int(time.time())  # updated once jobs are requested (may use server_time from condor_q)
 
+        # {schedd name: [(id, entered status time), ...], ...} of the history read, for advancing the cursors
+        self.history_scans = {}
+
     @staticmethod
     def _get_all_required_fields(desired_fields):
         """
@@ -1000,14 +2728,154 @@ class Condor(object):
 
         return required
 
-    def get_jobs(self, cache, desired_fields):
+    @staticmethod
+    def _read_history(schedd, constraint, fields, cursor):
         """
-        grabs all active condor jobs and those which ended since the daemon last run, which satisfy the config
-        constraint, that are known to every schedd known by the config collector. Returns a list of (unique) Job
-        instances with a classad containing (if present in the condor classad) the fields specified in
-        desired_fields (a list of classad field strings).
+        iterates (newest first) the schedd's history satisfying constraint, stopping at the job with id cursor
+        (if not None) which previous runs have read beyond. The bindings stream the history, so there's no
+        cap on the number of jobs read
         """
+        if cursor is None:
+            return schedd.history(constraint, fields, -1)
+        try:
+            return schedd.history(constraint, fields, -1, since='%s == "%s"' % (Ad.id, cursor))
+
+        # bindings predating 'since' must read the whole window of the constraint
+        except TypeError:
+            return schedd.history(constraint, fields, -1)
+
+    def _query_schedd(self, schedd_ad, cache, required_fields, desired_fields, history_constraint, emit,
+                      cursor_time=None):
+        """
+        grabs the active jobs and the jobs in the history (satisfying history_constraint, and newer than the
+        schedd's cursor) of a single schedd, passing each (as a Job) to emit. Returns (the schedd's server time
+        or None if it had no active jobs, [(id, entered status time), ...] of the history read). If the time to
+        which the cursor will be advanced is already known (cursor_time), only the job which will become the
+        cursor (see Cache.save_history_cursors) is kept of the history read
+        """
+        schedd = htcondor.Schedd(schedd_ad)
+        server_time = None
+
+        for ad in schedd.xquery(self.constraint, required_fields):
+            job = Job(ad, cache, self.config)
+            server_time = job.server_time
+
+            # inject BATCH_SUBMIT_SITE if required
+            if MockAd.batch_submit_site in desired_fields:
+                job.ad[MockAd.batch_submit_site] = schedd_ad["Machine"]
+            emit(job)
+
+        history_scan = []
+        cursor = cache.history_cursors.get(schedd_ad["Name"])
+        for ad in Condor._read_history(schedd, history_constraint, required_fields, cursor):
+            job = Job(ad, cache, self.config)
+            if cursor_time is None:
+                history_scan.append((job.id, job.entered_status_time))
+            elif job.entered_status_time > cursor_time:
+                history_scan = []
+            elif not history_scan:
+                history_scan = [(job.id, job.entered_status_time)]
+
+            # inject BATCH_SUBMIT_SITE if required
+            if MockAd.batch_submit_site in desired_fields:
+                job.ad[MockAd.batch_submit_site] = schedd_ad["Machine"]
+            emit(job)
+
+        return server_time, history_scan
+
+    def _query_all_schedds(self, cache, required_fields, desired_fields, history_constraint, consume=None,
+                           cursor_time=None):
+        """
+        queries every schedd in parallel using a bounded pool of worker threads, so that the time taken follows
+        the slowest schedd rather than the sum of them all. Returns a list (ordered as schedd_ads) of each
+        schedd's (jobs, server time, history scan) result, and a list of (schedd name, reason) for those which
+        failed or didn't respond within the config's timeout (whose results are None).
+        If consume is given, each job of a schedd is instead passed to it (in this thread) as soon as the
+        schedd's query completes, and the results' jobs are None. A schedd's jobs are held until then so that a
+        schedd which fails or times out contributes none of them, and a job found both active and in its history
+        is passed in its history state (as when collecting). cursor_time is passed to _query_schedd
+        """
+        tasks = Queue.Queue()
+        for index, schedd_ad in enumerate(self.schedd_ads):
+            tasks.put((index, schedd_ad))
+
+        # bounded when streaming, so that fast schedds can't outpace the consumer and pile up their jobs in memory
+        results = Queue.Queue(Condor.STREAM_QUEUE_MAX if consume else 0)
+        start_times = {}
+        answered = set()    # schedds whose query returned, though whose result may still be waiting to be queued
 
+        def work():
+            while True:
+                try:
+                    index, schedd_ad = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                start_times[index] = time.time()
+
+                jobs = {}
+                emit = lambda job: jobs.__setitem__(job.id, job)
+                try:
+                    server_time, history_scan = self._query_schedd(
+                        schedd_ad, cache, required_fields, desired_fields, history_constraint, emit, cursor_time)
+                    answered.add(index)
+                    results.put((index, (jobs, server_time, history_scan), None))
+                except Exception as e:
+                    answered.add(index)
+                    results.put((index, None, e))
+
+        def start_worker():
+            # a hung schedd query can't be interrupted, so its worker musn't keep the daemon from exiting
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+
+        for _ in range(max(1, min(self.config.schedd_query_workers, len(self.schedd_ads)))):
+            start_worker()
+
+        outcomes = [None] * len(self.schedd_ads)
+        failures = []
+        pending = set(range(len(self.schedd_ads)))
+        last_timeout_check = time.time()
+        while pending:
+            try:
+                index, outcome, error = results.get(timeout=1)
+            except Queue.Empty:
+                index = None
+
+            # results of schedds which already timed out are discarded
+            if (index is not None) and (index in pending):
+                if error is None:
+                    pending.remove(index)
+                    if consume:
+                        jobs, server_time, history_scan = outcome
+                        for job in jobs.itervalues():
+                            consume(job)
+                        outcome = (None, server_time, history_scan)
+                    outcomes[index] = outcome
+                else:
+                    pending.remove(index)
+                    failures.append((self.schedd_ads[index]["Name"], str(error)))
+
+            # abandon schedds which have exceeded their timeout, replacing their stuck workers. A schedd which
+            # answered in time isn't, though its result waits (behind those of others) to be taken
+            now = time.time()
+            if now - last_timeout_check >= 1:
+                last_timeout_check = now
+                for index in list(pending):
+                    if (index in start_times) and (index not in answered) and (
+                            now - start_times[index] > self.config.schedd_query_timeout):
+                        pending.remove(index)
+                        failures.append((self.schedd_ads[index]["Name"],
+                                         "no response within %s seconds" % self.config.schedd_query_timeout))
+                        start_worker()
+
+        return outcomes, failures
+
+    def _query_jobs(self, cache, desired_fields, consume=None, cursor_time=None):
+        """
+        queries every schedd for its jobs (see _query_all_schedds), handling failed schedds according to the
+        config, and returns the outcomes of those which succeeded (in schedd order)
+        """
         required_fields = Condor._get_all_required_fields(desired_fields)
 
         debug_print("The metrics desire fields...\n%s\nwhich means we ask condor for fields...\n%s" % (
@@ -1016,36 +2884,243 @@ class Condor(object):
 
         history_constraint = "((%s) && (EnteredCurrentStatus > %s))" % (self.constraint, cache.first_bin_start_time)
 
-        debug_print("Querying schedds with constraint '%s'" % self.constraint)
+        debug_print("Querying %s schedds with constraint '%s'" % (len(self.schedd_ads), self.constraint))
+
+        outcomes, failures = self._query_all_schedds(
+            cache, required_fields, desired_fields, history_constraint, consume, cursor_time)
+
+        # a missing schedd would silently under-report its jobs, so we only continue without it if configured to
+        if failures:
+            report = '\n'.join(["%s (%s)" % failure for failure in failures])
+            if not self.config.allow_partial_schedd_results:
+                raise RuntimeError("Querying the following schedds failed:\n%s\n" % report +
+                                   "Aborting the run so that the next will consider these jobs. Set '%s' " % (
+                                       Config.JSON_FIELD_ALLOW_PARTIAL_SCHEDD_RESULTS) +
+                                   "in the config (%s) to instead continue with the other schedds' jobs." % (
+                                       FileManager.FN_CONFIG))
+            print "Error! Querying the following schedds failed:\n%s\nContinuing without their jobs..." % report
+
+        succeeded = []
+        for schedd_ad, outcome in zip(self.schedd_ads, outcomes):
+            if outcome is not None:
+                jobs, server_time, history_scan = outcome
+                self.history_scans[schedd_ad["Name"]] = history_scan
+                succeeded.append(outcome)
+        return succeeded
+
+    def get_jobs(self, cache, desired_fields):
+        """
+        grabs all active condor jobs and those which ended since the daemon last run, which satisfy the config
+        constraint, that are known to every schedd known by the config collector. Returns a list of (unique) Job
+        instances with a classad containing (if present in the condor classad) the fields specified in
+        desired_fields (a list of classad field strings).
+        """
 
-        # we want unique jobs (no double counting)
+        # we want unique jobs (no double counting), merged in schedd order
         jobs = {}
-        for schedd_ad in self.schedd_ads:
+        for schedd_jobs, server_time, _ in self._query_jobs(cache, desired_fields):
+            jobs.update(schedd_jobs)
+            if server_time is not None:
+                self.current_time = server_time
+
+        return [jobs[id] for id in jobs]
+
+    def stream_jobs(self, cache, desired_fields, consume, cursor_time):
+        """
+        grabs the same jobs as get_jobs, though passes each unique Job to consume as soon as its schedd's
+        query completes rather than collecting them all, so that memory use follows the largest schedds rather
+        than the pool. Job ids are unique between schedds, so no others are kept. Of each schedd's history, only
+        the job which will become its cursor at cursor_time is kept. current_time remains the time the daemon
+        started.
+        """
+        num_jobs = [0]
 
-            schedd = htcondor.Schedd(schedd_ad)
+        def consume_counted(job):
+            num_jobs[0] += 1
+            consume(job)
 
-            for ad in schedd.xquery(self.constraint, required_fields):
-                job = Job(ad, cache, self.config)
-                jobs[job.id] = job
-                self.current_time = job.server_time
+        self._query_jobs(cache, desired_fields, consume_counted, cursor_time)
+        debug_print("%s unique jobs were streamed" % num_jobs[0])
 
-                # inject BATCH_SUBMIT_SITE if required
-                if MockAd.batch_submit_site in desired_fields:
-                    job.ad[MockAd.batch_submit_site] = schedd_ad["Machine"]
 
-            for ad in schedd.history(history_constraint, required_fields, 10000):
-                job = Job(ad, cache, self.config)
-                jobs[job.id] = job
+class MetricKind(object):
+    """
+    compiles a metric's declarative kind (e.g. kind = "count_running") into a calculate_over_bins function, which
+    evaluates every job at every bin at once through the jobs' table (if NumPy is installed, else job by job)
+    """
 
-                # inject BATCH_SUBMIT_SITE if required
-                if MockAd.batch_submit_site in desired_fields:
-                    job.ad[MockAd.batch_submit_site] = schedd_ad["Machine"]
+    # {kind name: (whether it requires a field, vectorized kernel, interpreted kernel)}, filled below
+    KINDS = {}
 
-        return [jobs[id] for id in jobs]
+    # kinds are written as a name, or a name and a field, e.g. "sum_rate(RemoteUserCpu)"
+    PATTERN = re.compile(r'^\s*(\w+)\s*(?:\(\s*(\w+)\s*\))?\s*$')
+
+    # most (jobs x bins) elements of an array evaluated at once, bounding the memory of the vectorized kernels
+    CHUNK_ELEMENTS_MAX = 2**22
+
+    # {(kind name, field or None): calculate_over_bins}, so that metrics of the same kind share a function
+    compiled = {}
+
+    @staticmethod
+    def parse(kind):
+        """returns (name, field or None) of a kind string, raising a RuntimeError if it isn't a known kind"""
+        match = MetricKind.PATTERN.match(kind)
+        name, field = match.groups() if match else (None, None)
+        if (name not in MetricKind.KINDS) or ((field is not None) != MetricKind.KINDS[name][0]):
+            raise RuntimeError("A metric declared kind '%s' which isn't one of: %s. Kinds marked (F) require a " % (
+                                   kind, ', '.join(sorted(name + ('(F)' if MetricKind.KINDS[name][0] else '')
+                                                          for name in MetricKind.KINDS))) +
+                               "classad field in place of F, e.g. sum_rate(RemoteUserCpu)")
+        return name, field
+
+    @staticmethod
+    def prepare(metric_class):
+        """
+        gives a metric class which declares a kind its compiled calculate_over_bins, and adds the kind's field to
+        those the metric declares it needs (and caches, if its kind needs the field's past values)
+        """
+        kind = getattr(metric_class, 'kind', None)
+        if kind is None:
+            return
+        if hasattr(metric_class, 'calculate_at_bin') or hasattr(metric_class, 'calculate_over_bins'):
+            raise RuntimeError("Metric %s declared both a kind and a calculation method! " % metric_class.__name__ +
+                               "Remove one of them.")
+
+        name, field = MetricKind.parse(kind)
+        if field is not None:
+            if field not in metric_class.fields:
+                metric_class.fields = metric_class.fields + [field]
+            if (name == "sum_rate") and (field not in metric_class.cache):
+                metric_class.cache = metric_class.cache + [field]
+
+        if (name, field) not in MetricKind.compiled:
+            MetricKind.compiled[(name, field)] = MetricKind._compile(name, field)
+        metric_class.calculate_over_bins = MetricKind.compiled[(name, field)]
+
+    @staticmethod
+    def _compile(name, field):
+        """returns a calculate_over_bins function of the kind, dispatching to its vectorized or interpreted kernel"""
+        _, vectorized, interpreted = MetricKind.KINDS[name]
+
+        def calculate_over_bins(self, bins, jobs):
+            if jobs and (numpy is not None):
+                MetricKind._run_vectorized(vectorized, self, bins, jobs, field)
+            else:
+                interpreted(self, bins, jobs, field)
+            return [getattr(time_bin, Bin.AGGREGATIONS[MetricKind._get_aggregation(name)][1])() for time_bin in bins]
+
+        calculate_over_bins.__name__ = name
+        return calculate_over_bins
+
+    @staticmethod
+    def _get_aggregation(name):
+        """returns the Bin aggregation into which a kind's values are added"""
+        return 'time average' if (name == "time_average") else 'sum'
+
+    @staticmethod
+    def _run_vectorized(kernel, metric_inst, bins, jobs, field):
+        """runs the vectorized kernel over chunks of contiguous bins, each evaluating (jobs x bins) arrays"""
+        tag_codes = jobs.table.get_tag_codes(metric_inst.tags)
+        chunk_size = max(1, MetricKind.CHUNK_ELEMENTS_MAX // len(jobs))
+        for i in range(0, len(bins), chunk_size):
+            chunk = bins[i: i + chunk_size]
+            kernel(chunk, jobs, tag_codes, field,
+                   [time_bin.start_time for time_bin in chunk], [time_bin.end_time for time_bin in chunk])
+
+    # vectorized kernels, given the bins' start and end times, and each job's tag codes
+
+    @staticmethod
+    def _count_running_vectorized(bins, jobs, tag_codes, field, t0s, t1s):
+        running = jobs.table.is_running_during(t0s, t1s)
+        for i, time_bin in enumerate(bins):
+            time_bin.add_batch_to_sum(tag_codes[running[:, i]], 1)
+
+    @staticmethod
+    def _count_idle_vectorized(bins, jobs, tag_codes, field, t0s, t1s):
+        idle = jobs.table.is_idle_during(t0s, t1s)
+        for i, time_bin in enumerate(bins):
+            time_bin.add_batch_to_sum(tag_codes[idle[:, i]], 1)
+
+    @staticmethod
+    def _sum_rate_vectorized(bins, jobs, tag_codes, field, t0s, t1s):
+        changes = jobs.table.get_changes_in_value_when_running_over(field, t0s, t1s)
+        durations = jobs.table.get_time_running_in(t0s, t1s)
+        for i, time_bin in enumerate(bins):
+            running = durations[:, i] > 0
+            time_bin.add_batch_to_sum(tag_codes[running], changes[running, i] /
+                                      float(time_bin.end_time - time_bin.start_time))
+
+    @staticmethod
+    def _time_average_vectorized(bins, jobs, tag_codes, field, t0s, t1s):
+        vals = jobs.table.get_values(field).reshape(-1, 1)
+        durations = jobs.table.get_time_running_in(t0s, t1s)
+
+        # every (tag code, bin) pair is summed in one pass, numbering the pairs (distinct code index x bin)
+        codes, code_indices = numpy.unique(tag_codes, return_inverse=True)
+        pairs = (code_indices.reshape(-1, 1) * len(bins) + numpy.arange(len(bins)).reshape(1, -1)).ravel()
+        totals = numpy.bincount(pairs, weights=(vals * durations).ravel(), minlength=len(codes) * len(bins))
+        total_durations = numpy.bincount(pairs, weights=durations.ravel(), minlength=len(codes) * len(bins))
+
+        for pair in numpy.flatnonzero(total_durations).tolist():
+            code_index, i = divmod(pair, len(bins))
+            Bin._add_reduced_batch(bins[i].time_average_vals, [int(codes[code_index])], [float(totals[pair])],
+                                   [int(total_durations[pair])])
+
+    # interpreted kernels, visiting each job only at the bins it covers
+
+    @staticmethod
+    def _count_running_interpreted(metric_inst, bins, jobs, field):
+        for job in jobs:
+            tags = job.get_values(metric_inst.tags)
+            for time_bin in job.get_bins_running_during(bins):
+                time_bin.add_to_sum(1, tags)
+
+    @staticmethod
+    def _count_idle_interpreted(metric_inst, bins, jobs, field):
+        for job in jobs:
+            tags = job.get_values(metric_inst.tags)
+            for time_bin in job.get_bins_idle_during(bins):
+                time_bin.add_to_sum(1, tags)
+
+    @staticmethod
+    def _sum_rate_interpreted(metric_inst, bins, jobs, field):
+        for job in jobs:
+            tags = job.get_values(metric_inst.tags)
+            rate = float(job.get_rate_of_change_of_value_when_running(field))
+            for time_bin in job.get_bins_running_during(bins):
+                duration = job.get_time_running_in(time_bin.start_time, time_bin.end_time)
+                if duration > 0:
+                    time_bin.add_to_sum(rate * duration / float(time_bin.end_time - time_bin.start_time), tags)
+
+    @staticmethod
+    def _time_average_interpreted(metric_inst, bins, jobs, field):
+        for job in jobs:
+            tags = job.get_values(metric_inst.tags)
+            val = float(job.get_values([field])[field])
+            for time_bin in job.get_bins_running_during(bins):
+                duration = job.get_time_running_in(time_bin.start_time, time_bin.end_time)
+                if duration > 0:
+                    time_bin.add_to_time_average(val, tags, duration)
+
+
+MetricKind.KINDS = {
+    "count_running": (False, MetricKind._count_running_vectorized, MetricKind._count_running_interpreted),
+    "count_idle": (False, MetricKind._count_idle_vectorized, MetricKind._count_idle_interpreted),
+    "sum_rate": (True, MetricKind._sum_rate_vectorized, MetricKind._sum_rate_interpreted),
+    "time_average": (True, MetricKind._time_average_vectorized, MetricKind._time_average_interpreted)}
 
 
 class MetricManager(object):
 
+    # number of streamed jobs given to a metric's calculate_over_bins at once, amortising its building of results
+    STREAM_BATCH_SIZE = 1000
+
+    # states to which a metric may declare its calculation confined (by attribute span), and the job's span therein
+    SPANS = {
+        "running": Job.get_most_recent_time_span_running,
+        "idle": Job.get_most_recent_time_span_idle
+    }
+
     DEFAULT_METRICS = '''
 #!/usr/bin/env python
 
@@ -1076,11 +3151,29 @@ add_to_sum(val, tags)
 add_to_job_average(val, tags)
 add_to_time_average(val, tags, duration)
 add_to_division_of_sums(num, den, tags)
+add_to_quantiles(val, tags)              - for estimating quantiles (e.g. the median)
+                                           of the values, to within QUANTILE ACCURACY
+add_to_distinct(key, tags)               - for counting distinct keys (see get_distinct)
+
+add_batch_to_sum(tag_codes, vals)        - as above, adding many values at once, where
+add_batch_to_job_average(tag_codes, vals)  tag_codes (from jobs.table.get_tag_codes)
+add_batch_to_time_average(tag_codes,       and vals are NumPy arrays (or vals is a
+                          vals, durations) single value for all). e.g.
+add_batch_to_division_of_sums(tag_codes,     running = jobs.table.is_running_during(
+                              nums, dens)        [t0], [t1])[:, 0]
+                                             time_bin.add_batch_to_sum(
+                                                 jobs.table.get_tag_codes(self.tags)[running], 1)
 
 get_sum()
 get_job_average()
 get_time_average()
 get_division_of_sums()
+get_quantiles(qs)                        - given a list of quantiles (e.g. [0.5, 0.95]),
+                                           returns [({'p50': val, 'p95': val}, tags), ...],
+                                           each quantile becoming its own influx field
+get_distinct()                           - returns the estimated number of distinct keys
+                                           (e.g. Owners) added by add_to_distinct(key, tags),
+                                           to within about 2.3% (one standard error)
 --------------------------------------------------------------------------------------
 job attributes...
 
@@ -1116,24 +3209,45 @@ is_running_during(t0, t1)
 get_time_idle_in(t0, t1)        - returns duration for which job is idle in [t0, t1]
 get_time_running_in(t0, t1)
 
+get_bins_idle_during(bins)      - returns those of the bins (as passed to
+get_bins_running_during(bins)     calculate_over_bins) in which the job was ever idle
+
 get_rate_of_change_of_value_when_running(field)
 get_change_in_value_when_running_over(field, t0, t1)
 get_value_when_running_at(field, t)
+
+invalidate_memos()              - the job's spans and values are memoised for the
+                                  run, so this must be called if a metric changes
+                                  the job's ad
 --------------------------------------------------------------------------------------
-"""
+jobs attributes (requires NumPy)...
+
+table                           - the jobs as columns, evaluated all at once, with
+                                  rows in the order of jobs. e.g.
+                                  jobs.table.is_running_during([t0], [t1])[:, 0]
+
+job table methods...
+
+get_most_recent_time_spans_idle()    - returns arrays (starts, ends) of every job's
+                                       most recent time being idle (ends are 0
+                                       if still idle)
+get_most_recent_time_spans_running() - [as above]. Starts are 0 if never run
 
-def count_idle_jobs(self, time_bin, jobs):
-    for job in jobs:
-        if job.is_idle_during(time_bin.start_time, time_bin.end_time):
-            time_bin.add_to_sum(1, job.get_values(self.tags))
-    return time_bin.get_sum()
+is_idle_during(t0s, t1s)        - returns a (jobs x bins) boolean array of whether
+is_running_during(t0s, t1s)       each job was idle in each bin [t0s[i], t1s[i]]
 
-def count_running_jobs(self, time_bin, jobs):
-    for job in jobs:
-        if job.is_running_during(time_bin.start_time, time_bin.end_time):
-            time_bin.add_to_sum(1, job.get_values(self.tags))
-    return time_bin.get_sum()
+get_time_idle_in(t0s, t1s)      - returns a (jobs x bins) array of the duration
+get_time_running_in(t0s, t1s)     each job is idle in each bin
 
+get_rates_of_change_of_value_when_running(field)  - returns an array of each job's rate
+get_changes_in_value_when_running_over(field,       (or a (jobs x bins) array of each
+                                       t0s, t1s)    job's change in each bin)
+get_values_when_running_at(field, t)              - returns an array of each job's value at t
+
+get_tag_codes(fields)           - returns an array of each job's code of its values
+                                  of fields (e.g. self.tags), for the batch methods
+--------------------------------------------------------------------------------------
+"""
 
 """
     attributes:
@@ -1153,6 +3267,26 @@ def count_running_jobs(self, time_bin, jobs):
                            This should be a subset of fields, though the daemon will forgive
                            you if you forgot to put any fields needed to be cache in fields
                            (it will add them)
+        span             - (optional) "running" or "idle", if the metric only considers
+                           jobs at bins in which they're in that state. The daemon then
+                           gives calculate_at_bin only those jobs, rather than all jobs
+        kind             - (in place of the methods below) one of the daemon's built-in
+                           calculations, which evaluate every job at every bin at once:
+                               "count_running"  - number of jobs running in each bin
+                               "count_idle"     - number of jobs idle in each bin
+                               "sum_rate(F)"    - total rate (per second) at which the
+                                                  field F changed while jobs ran in each
+                                                  bin (e.g. CPUs used, for RemoteUserCpu)
+                               "time_average(F)" - average of the (current) field F over
+                                                  the jobs running in each bin, weighted
+                                                  by the time each ran therein
+                           F is added to the metric's fields (and cache, for sum_rate)
+
+    methods (one of):
+        calculate_at_bin(time_bin, jobs)  - returns the metric's results at a single bin
+        calculate_over_bins(bins, jobs)   - returns a list of the metric's results at every
+                                            bin, so each job can be visited only once and
+                                            added to all the bins it spans (preferred)
 """
 
 class RunningPerSitesMetric:
@@ -1161,7 +3295,7 @@ class RunningPerSitesMetric:
     tags = ["SUBMIT_SITE", "MATCH_EXP_JOB_Site"]
     fields = []
     cache = []
-    calculate_at_bin = count_running_jobs
+    kind = "count_running"
 
 class RunningPerOwnerAndSubmitSiteMetric:
     db = "GlideInMetrics"
@@ -1169,7 +3303,7 @@ class RunningPerOwnerAndSubmitSiteMetric:
     tags = ["SUBMIT_SITE", "Owner"]
     fields = []
     cache = []
-    calculate_at_bin = count_running_jobs
+    kind = "count_running"
 
 class IdlePerOwnerAndSubmitMetric:
     db = "GlideInMetrics"
@@ -1177,7 +3311,7 @@ class IdlePerOwnerAndSubmitMetric:
     tags = ["SUBMIT_SITE", "Owner"]
     fields = []
     cache = []
-    calculate_at_bin = count_idle_jobs
+    kind = "count_idle"
 
 class IdlePerSubmitMetric:
     db = "GlideInMetrics"
@@ -1185,7 +3319,7 @@ class IdlePerSubmitMetric:
     tags = ["SUBMIT_SITE"]
     fields = []
     cache = []
-    calculate_at_bin = count_idle_jobs
+    kind = "count_idle"
 '''
 
     def __init__(self):
@@ -1201,6 +3335,7 @@ class IdlePerSubmitMetric:
             # grab all classes declared in the metrics file
             for _, obj in inspect.getmembers(metrics):
                 if inspect.isclass(obj) and (obj.__module__ == module_name):
+                    MetricKind.prepare(obj)
                     self.metrics.append(obj)
 
         # otherwise create a default metrics spec file
@@ -1223,36 +3358,139 @@ class IdlePerSubmitMetric:
 
         return list(fields)
 
+    @staticmethod
+    def _get_valid_bitmap(metric_inst, index):
+        """
+        returns the bitmap (of the FieldIndex) of the jobs which contain all the fields the metric needs,
+        reporting how many jobs were excluded for lacking some
+        """
+        bitmap = index.get_bitmap(metric_inst.tags + metric_inst.fields + metric_inst.cache)
+        num_excluded = len(index.jobs) - FieldIndex.count(bitmap)
+        if num_excluded:
+            debug_print("%s of the %s jobs were excluded from this metric (the metric needed fields %s, " % (
+                num_excluded, len(index.jobs), metric_inst.tags + metric_inst.fields + metric_inst.cache) +
+                "some of which they didn't contain)")
+        return bitmap
+
+    @staticmethod
+    def _get_span_getter(metric_inst):
+        """
+        returns a function giving a job's span (start, end) in the state to which the metric declared its
+        calculation is confined (by its optional span attribute), or None if it didn't declare one
+        """
+        span = getattr(metric_inst, 'span', None)
+        if span is None:
+            return None
+        if span not in MetricManager.SPANS:
+            raise RuntimeError("Metric %s declared span '%s' which isn't one of %s! " % (
+                                   metric_inst.__class__.__name__, span, ', '.join(MetricManager.SPANS.keys())) +
+                               "Remove the span attribute to have the metric consider all jobs at every bin.")
+        return MetricManager.SPANS[span]
+
+    @staticmethod
+    def _calculate_metric(metric_inst, bins, jobs):
+        """returns the metric's results at each of the (contiguous) bins, given only the jobs valid for it"""
+
+        # metrics which can visit each job once to calculate every bin are preferred
+        if hasattr(metric_inst, 'calculate_over_bins'):
+            return metric_inst.calculate_over_bins(bins, jobs)
+
+        # a metric confined to a state need only be given the jobs in that state during each bin
+        get_span = MetricManager._get_span_getter(metric_inst)
+        if get_span is None:
+            jobs_by_bin = itertools.repeat(jobs)
+        else:
+            bin_duration = bins[0].end_time - bins[0].start_time
+            bin_times = [time_bin.start_time for time_bin in bins]
+            jobs_by_bin = BinIndex(bin_times, bin_duration).iter_jobs_by_bin(jobs, get_span)
+
+        # calculate the metric at each time bin using only filtered jobs
+        all_results = []
+        num_considered = 0
+        for time_bin, bin_jobs in itertools.izip(bins, jobs_by_bin):
+            all_results.append(metric_inst.calculate_at_bin(
+                time_bin, bin_jobs if get_span is None else JobList(bin_jobs)))
+            num_considered += len(bin_jobs)
+
+        debug_print("%s of the %s possible (job, bin) pairs were considered" % (
+            num_considered, len(jobs) * len(bins)))
+        return all_results
+
     def process_metrics(self, bin_times, bin_duration, jobs, outbox):
 
+        # which jobs contain each needed field is found once, for every metric to filter the jobs by
+        index = FieldIndex(jobs, self.get_all_desired_fields())
+
         for metric_class in self.metrics:
 
             metric_inst = metric_class()
             debug_print("Processing metric: %s %s" % (metric_inst.mes, '(' + ', '.join(metric_inst.tags) + ')'))
 
             # filter for only jobs which contain the fields the metric needs
-            valid_jobs = []
-            for job in jobs:
-                try:
-                    job.get_values(metric_inst.tags)
-                    job.get_values(metric_inst.fields)
-                    job.get_values(metric_inst.cache)
-                    valid_jobs.append(job)
-                except RuntimeError as e:
-                    debug_print("The following job was excluded from this metric (the metric " +
-                                "needed fields %s, some of which weren't present)" % (
-                                    metric_inst.tags + metric_inst.fields))
-                    debug_print(prettify(job.ad))
-                    debug_print("The caught error reads:\n%s" % str(e))
-                    continue
+            valid_jobs = index.get_jobs(MetricManager._get_valid_bitmap(metric_inst, index))
 
             # calculate the metric at each time bin using only filtered jobs
-            for t in bin_times:
-                time_bin = Bin(t, t + bin_duration)
-                results = metric_inst.calculate_at_bin(time_bin, valid_jobs)
+            bins = [Bin(t, t + bin_duration) for t in bin_times]
+            all_results = MetricManager._calculate_metric(metric_inst, bins, valid_jobs)
+            for time_bin, results in itertools.izip(bins, all_results):
+                outbox.add(metric_inst.db, metric_inst.mes, results, time_bin.start_time)
+
+            debug_print("At the final bin, metric %s %s yielded %s" % (
+                metric_inst.mes, '(' + ', '.join(metric_inst.tags) + ')', prettify(results)))
+
+        debug_print("Job memoisation %s" % Job.get_memo_report())
+
+    def start_stream(self, bin_times, bin_duration):
+        """
+        prepares every metric's bins to have jobs streamed into them in batches (by stream_job), in place of
+        process_metrics. This relies on metrics aggregating solely through their bins, as calculate_over_bins is
+        called once per batch of jobs, and then a final time (with the last batch) for the results. Metrics
+        calculated at each bin (whose results would be rebuilt for every job) can't be streamed, so raise a
+        RuntimeError
+        """
+        unstreamable = [metric_class.__name__ for metric_class in self.metrics
+                        if not hasattr(metric_class, 'calculate_over_bins')]
+        if unstreamable:
+            raise RuntimeError("The config's (%s) '%s' field is true, but metrics %s don't declare a " % (
+                                   FileManager.FN_CONFIG, Config.JSON_FIELD_STREAM_JOBS, ', '.join(unstreamable)) +
+                               "kind or calculate_over_bins, so can't be given jobs as they're streamed. Declare " +
+                               "one (see the README), or set the field false.")
+
+        self.streams = []
+        self.stream_exclusions = [0] * len(self.metrics)
+        self.stream_num_jobs = 0
+        for metric_class in self.metrics:
+            self.streams.append((metric_class(), [Bin(t, t + bin_duration) for t in bin_times], JobList()))
+
+    def stream_job(self, job):
+        """aggregates the job into the bins of every metric for which it contains the needed fields"""
+        self.stream_num_jobs += 1
+        for metric_index, (metric_inst, bins, batch) in enumerate(self.streams):
+            if not FieldIndex.has_fields(job, metric_inst.tags + metric_inst.fields + metric_inst.cache):
+                self.stream_exclusions[metric_index] += 1
+                continue
+
+            batch.append(job)
+            if len(batch) >= MetricManager.STREAM_BATCH_SIZE:
+                metric_inst.calculate_over_bins(bins, batch)
+                batch.clear()
+
+    def end_stream(self, outbox):
+        """adds the results of every metric's bins, once all jobs have been streamed, to the outbox"""
+        for (metric_inst, bins, batch), num_excluded in itertools.izip(self.streams, self.stream_exclusions):
+            debug_print("Processing metric: %s %s" % (metric_inst.mes, '(' + ', '.join(metric_inst.tags) + ')'))
+            if num_excluded:
+                debug_print("%s of the %s jobs were excluded from this metric (the metric needed fields %s, " % (
+                    num_excluded, self.stream_num_jobs, metric_inst.tags + metric_inst.fields + metric_inst.cache) +
+                    "some of which they didn't contain)")
+            all_results = metric_inst.calculate_over_bins(bins, batch)
+            for time_bin, results in itertools.izip(bins, all_results):
                 outbox.add(metric_inst.db, metric_inst.mes, results, time_bin.start_time)
 
             debug_print("At the final bin, metric %s yielded %s" % (metric_inst.mes, prettify(results)))
+        self.streams = []
+
+        debug_print("Job memoisation %s" % Job.get_memo_report())
 
     def are_no_metrics(self):
         return not len(self.metrics)
@@ -1289,22 +3527,45 @@ def main():
     condor = Condor(config)
     outbox = Outbox(config)
 
+    # every quantile sketch is made to the configured accuracy, and every connection to influx given its timeout
+    QuantileSketch.relative_accuracy = config.quantile_accuracy
+    NetworkManager.connection_pool.timeout = config.influx_timeout
+
     # let's exit early (note we're dodging caching) if there's no metrics to collect
     if metricmngr.are_no_metrics():
         print "There are zero specified metrics. Exiting."
         exit()
 
-    # get jobs
-    jobs = condor.get_jobs(cache, metricmngr.get_all_desired_fields())
+    if config.stream_jobs:
+        final_bin_end_time = stream_jobs(metricmngr, config, cache, condor, outbox)
+    else:
+        final_bin_end_time = collect_jobs(metricmngr, config, cache, condor, outbox)
 
-    # allocate time since previous run into bins
+    # the next run need only read the history beyond what was read this run
+    Cache.save_history_cursors(final_bin_end_time, condor.history_scans, cache.history_cursors)
+
+
+def get_bin_times(cache, condor, config):
+    """
+    allocates the time since the previous run into bins, returning (bin start times, final bin end time).
+    Exits if no whole bin has yet transpired
+    """
     bin_times = range(cache.first_bin_start_time, condor.current_time, config.bin_duration)
     if len(bin_times) < 2:
         print ("The daemon has been run too recently at %s; no bins (duration %s) have transpired" % (
             cache.first_bin_start_time, config.bin_duration))
         exit()
-    bin_start_times, final_bin_end_time = bin_times[:-1], bin_times[-1]
-    del bin_times
+    return bin_times[:-1], bin_times[-1]
+
+
+def collect_jobs(metricmngr, config, cache, condor, outbox):
+    """processes the metrics over all jobs, once collected from condor. Returns the final bin's end time"""
+
+    # get jobs
+    jobs = condor.get_jobs(cache, metricmngr.get_all_desired_fields())
+
+    # allocate time since previous run into bins
+    bin_start_times, final_bin_end_time = get_bin_times(cache, condor, config)
 
     # calc every metric at every bin and add results to the outbox
     metricmngr.process_metrics(bin_start_times, config.bin_duration, jobs, outbox)
@@ -1314,6 +3575,40 @@ def main():
     outbox.save()
 
     # cache any required fields
-    Cache.save_time_and_running_values(final_bin_end_time, jobs, metricmngr.get_fields_to_cache())
+    cache.save_time_and_running_values(final_bin_end_time, jobs, metricmngr.get_fields_to_cache())
+    return final_bin_end_time
+
+
+def stream_jobs(metricmngr, config, cache, condor, outbox):
+    """
+    processes the metrics over jobs as they're streamed from condor, never holding them all at once.
+    Returns the final bin's end time
+    """
+
+    # the bins must be known before any jobs arrive, so end by the time the daemon started
+    bin_start_times, final_bin_end_time = get_bin_times(cache, condor, config)
+    fields_to_cache = metricmngr.get_fields_to_cache()
+
+    # every job is aggregated into the metrics and cached as soon as it arrives, then discarded (with its values
+    # looked up from the cache). Only the values to be cached of running jobs are kept
+    values = {}
+    def consume(job):
+        metricmngr.stream_job(job)
+        Cache.add_running_values(final_bin_end_time, job, fields_to_cache, values)
+        cache.forget_values(job)
+
+    metricmngr.start_stream(bin_start_times, config.bin_duration)
+    condor.stream_jobs(cache, metricmngr.get_all_desired_fields(), consume, final_bin_end_time)
+    metricmngr.end_stream(outbox)
+
+    # push outbox to influx
+    outbox.push_outgoing()
+    outbox.save()
+
+    # cache any required fields
+    cache.save_time_and_values(final_bin_end_time, values)
+    return final_bin_end_time
+
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# Purpose:      tests that the daemon's cache stores give back what they saved, and that the log store survives
+#               torn saves and compaction
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import daemon
+
+
+# the values of a cache over three runs, in which jobs join, leave and change value
+RUNS = [
+    (1000, {"a#1": (2, {"RemoteUserCpu": 10, "RemoteSysCpu": 1}),
+            "a#2": (2, {"RemoteUserCpu": 20, "RemoteSysCpu": 2}),
+            "a#3": (1, {"RemoteUserCpu": 0, "RemoteSysCpu": 0})}),
+    (1300, {"a#1": (2, {"RemoteUserCpu": 310, "RemoteSysCpu": 31}),
+            "a#3": (2, {"RemoteUserCpu": 50, "RemoteSysCpu": 5}),
+            "a#4": (1, {"RemoteUserCpu": 0, "RemoteSysCpu": 0})}),
+    (1600, {"a#1": (2, {"RemoteUserCpu": 610, "RemoteSysCpu": 61}),
+            "a#4": (2, {"RemoteUserCpu": 7.5, "RemoteSysCpu": 0.5}),
+            "a#5": (1, {"RemoteUserCpu": 0})})
+]
+
+
+class CacheStoreTest(unittest.TestCase):
+    """runs in a new temporary directory, in which each store keeps its files"""
+
+    def setUp(self):
+        self.prev_debug_print = daemon.DEBUG_PRINT
+        daemon.DEBUG_PRINT = False
+        self.prev_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.prev_directory)
+        shutil.rmtree(self.directory)
+        daemon.DEBUG_PRINT = self.prev_debug_print
+
+    def assert_holds(self, store, t, values, unknown_ids=("a#0",)):
+        """asserts the store has the time t and every job's values, and no others"""
+        self.assertEqual(store.bin_time, t)
+        for job_id, (status, jobvals) in values.iteritems():
+            self.assertEqual(tuple(store.get(job_id)), (status, jobvals))
+        for job_id in unknown_ids:
+            self.assertEqual(store.get(job_id), None)
+
+
+class StoresTest(CacheStoreTest):
+
+    def test_empty_store_has_no_time(self):
+        for store_class in daemon.Cache.STORES.values():
+            self.assertEqual(store_class().bin_time, None)
+
+    def test_stores_give_back_each_save(self):
+        for name, store_class in daemon.Cache.STORES.items():
+            for i, (t, values) in enumerate(RUNS):
+
+                # each run looks up its jobs in a new store, then saves
+                store = store_class()
+                if i:
+                    self.assert_holds(store, RUNS[i - 1][0], RUNS[i - 1][1])
+                store.save(t, values)
+
+                gone = [job_id for prev_t, prev_values in RUNS[:i] for job_id in prev_values if job_id not in values]
+                self.assert_holds(store_class(), t, values, gone)
+
+
+class LogCacheStoreTest(CacheStoreTest):
+
+    def save_runs(self, runs):
+        for t, values in runs:
+            daemon.LogCacheStore().save(t, values)
+
+    def get_log(self):
+        with open(daemon.FileManager.FN_CACHE_LOG, 'rb') as f:
+            return f.read()
+
+    def append_to_log(self, string):
+        with open(daemon.FileManager.FN_CACHE_LOG, 'ab') as f:
+            f.write(string)
+
+    def test_save_appends_only_changes(self):
+        self.save_runs(RUNS[:1])
+        size = len(self.get_log())
+        daemon.LogCacheStore().save(RUNS[0][0] + 300, RUNS[0][1])
+        self.assertEqual(self.get_log()[size:], '["c",%s]\n' % (RUNS[0][0] + 300))
+
+    def test_replay_discards_torn_record(self):
+        self.save_runs(RUNS[:2])
+        log = self.get_log()
+        self.append_to_log('["u","a#9",2,{"RemoteUserCpu":')
+
+        self.assert_holds(daemon.LogCacheStore(), RUNS[1][0], RUNS[1][1], ["a#9"])
+        self.assertEqual(self.get_log(), log)
+
+    def test_replay_discards_uncommitted_save(self):
+        self.save_runs(RUNS[:2])
+        log = self.get_log()
+        self.append_to_log('["u","a#9",2,{"RemoteUserCpu":1}]\n["r","a#1"]\n')
+
+        self.assert_holds(daemon.LogCacheStore(), RUNS[1][0], RUNS[1][1], ["a#9"])
+        self.assertEqual(self.get_log(), log)
+
+        # the store saves after the discarded records as normal
+        self.save_runs(RUNS[2:])
+        self.assert_holds(daemon.LogCacheStore(), RUNS[2][0], RUNS[2][1])
+
+    def test_replay_discards_unparseable_record_and_beyond(self):
+        self.save_runs(RUNS[:1])
+        log = self.get_log()
+        self.append_to_log('not json\n["c",9999]\n')
+
+        self.assert_holds(daemon.LogCacheStore(), RUNS[0][0], RUNS[0][1])
+        self.assertEqual(self.get_log(), log)
+
+    def test_appended_time_looks_into_the_past(self):
+        self.save_runs(RUNS[:1])
+        self.append_to_log('["c",500]\n')
+        self.assert_holds(daemon.LogCacheStore(), 500, RUNS[0][1])
+
+    def test_compaction_empties_log_into_snapshot(self):
+        prev_ratio = daemon.LogCacheStore.COMPACTION_RATIO
+        daemon.LogCacheStore.COMPACTION_RATIO = 1
+        try:
+            self.save_runs(RUNS)
+        finally:
+            daemon.LogCacheStore.COMPACTION_RATIO = prev_ratio
+
+        self.assertTrue(os.path.exists(daemon.FileManager.FN_CACHE_SNAPSHOT))
+        self.assertFalse(os.path.exists(daemon.FileManager.FN_CACHE_SNAPSHOT + daemon.FileManager.SUFFIX_TEMP))
+        self.assertEqual(self.get_log(), '')
+        store = daemon.LogCacheStore()
+        self.assertEqual(store.num_log_records, 0)
+        self.assert_holds(store, RUNS[2][0], RUNS[2][1], ["a#2", "a#3"])
+
+    def test_compaction_torn_before_log_emptied(self):
+        self.save_runs(RUNS)
+        log = self.get_log()
+
+        # the daemon dies once the snapshot is written, but before the log is emptied
+        store = daemon.LogCacheStore()
+        store._compact()
+        with open(daemon.FileManager.FN_CACHE_LOG, 'wb') as f:
+            f.write(log)
+
+        self.assert_holds(daemon.LogCacheStore(), RUNS[2][0], RUNS[2][1], ["a#2", "a#3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
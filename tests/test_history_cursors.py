@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Purpose:      tests that the daemon's schedd history cursors advance only past jobs within the bins, and are
+#               skipped where they'd miss jobs
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import daemon
+
+
+class StandInConfig(object):
+    initial_values = daemon.Config.JSON_VALUE_INIT_VALUES_DEFAULT
+    cache_store = "json"
+
+
+class StandInSchedd(object):
+    """a schedd whose history reading records its arguments, and which may predate the bindings' 'since'"""
+
+    def __init__(self, has_since=True):
+        self.has_since = has_since
+        self.calls = []
+
+    def history(self, constraint, fields, match, **kwargs):
+        if kwargs and not self.has_since:
+            raise TypeError("history() got an unexpected keyword argument 'since'")
+        self.calls.append((constraint, fields, match, kwargs.get('since')))
+        return iter([])
+
+
+class HistoryCursorTest(unittest.TestCase):
+    """runs in a new temporary directory, in which the cursors (and cache) are kept"""
+
+    def setUp(self):
+        self.prev_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.prev_directory)
+        shutil.rmtree(self.directory)
+
+    def load_cache(self, bin_time):
+        """returns the Cache of the next run, whose bins start at bin_time"""
+        daemon.JsonCacheStore().save(bin_time, {})
+        return daemon.Cache(StandInConfig())
+
+    def test_cursor_advances_to_newest_job_within_bins(self):
+        scans = {"schedd0": [("s0#5", 1500), ("s0#4", 1200), ("s0#3", 1000), ("s0#2", 900)]}
+        daemon.Cache.save_history_cursors(1200, scans, {})
+        self.assertEqual(self.load_cache(1200).history_cursors, {"schedd0": "s0#4"})
+
+    def test_cursor_skips_past_no_job_beyond_bins(self):
+
+        # s0#3 ended within the bins, but is read after (so is older in the history than) one which didn't
+        scans = {"schedd0": [("s0#5", 1100), ("s0#4", 1300), ("s0#3", 1000), ("s0#2", 900)]}
+        daemon.Cache.save_history_cursors(1200, scans, {})
+        self.assertEqual(self.load_cache(1200).history_cursors, {"schedd0": "s0#3"})
+
+    def test_cursor_kept_when_no_job_within_bins(self):
+        prev_cursors = {"schedd0": "s0#1", "schedd1": "s1#1"}
+        scans = {"schedd0": [("s0#5", 1500)], "schedd1": []}
+        daemon.Cache.save_history_cursors(1200, scans, prev_cursors)
+        self.assertEqual(self.load_cache(1200).history_cursors, prev_cursors)
+
+    def test_cursor_of_failed_schedd_kept(self):
+        prev_cursors = {"schedd0": "s0#1", "schedd1": "s1#1"}
+        daemon.Cache.save_history_cursors(1200, {"schedd0": [("s0#2", 1100)]}, prev_cursors)
+        self.assertEqual(self.load_cache(1200).history_cursors, {"schedd0": "s0#2", "schedd1": "s1#1"})
+
+    def test_cursors_skipped_when_looking_into_the_past(self):
+        daemon.Cache.save_history_cursors(1200, {"schedd0": [("s0#2", 1100)]}, {})
+        self.assertEqual(self.load_cache(1200).history_cursors, {"schedd0": "s0#2"})
+        self.assertEqual(self.load_cache(1500).history_cursors, {"schedd0": "s0#2"})
+        self.assertEqual(self.load_cache(1199).history_cursors, {})
+
+    def test_no_cursors_without_file(self):
+        self.assertEqual(self.load_cache(1200).history_cursors, {})
+
+    def test_history_read_since_cursor(self):
+        schedd = StandInSchedd()
+        daemon.Condor._read_history(schedd, "true", ["GlobalJobId"], "s0#4")
+        self.assertEqual(schedd.calls, [("true", ["GlobalJobId"], -1, 'GlobalJobId == "s0#4"')])
+
+    def test_history_read_whole_without_cursor(self):
+        schedd = StandInSchedd()
+        daemon.Condor._read_history(schedd, "true", ["GlobalJobId"], None)
+        self.assertEqual(schedd.calls, [("true", ["GlobalJobId"], -1, None)])
+
+    def test_history_read_whole_by_bindings_without_since(self):
+        schedd = StandInSchedd(has_since=False)
+        daemon.Condor._read_history(schedd, "true", ["GlobalJobId"], "s0#4")
+        self.assertEqual(schedd.calls, [("true", ["GlobalJobId"], -1, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Purpose:      tests that the daemon's outbox repairs the segments left by a run which died, and evicts its
+#               oldest segments once too big
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import daemon
+
+
+class StandInConfig(object):
+    """a config whose influx can't be reached (nothing listens on port 1), so every push fails"""
+    database_url = "http://127.0.0.1:1/"
+    influx_username = "admin"
+    influx_password = "password"
+    write_compression_level = 0
+    write_compression_min_bytes = 0
+    write_batch_bytes = 64
+    write_workers_per_database = 1
+    outbox_max_bytes = 1024
+    known_database_ttl = 60
+
+
+def get_segment_filename(number, database):
+    return daemon.Outbox._get_segment_filename(number, database)
+
+
+def get_line(mes, val, tags, t):
+    """returns the line (with its newline) of the value as the outbox stores it"""
+    return daemon.NetworkManager.stringify_bin_data(mes, [(val, tags)], t) + '\n'
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def write_file(filename, string):
+    with open(filename, 'wb') as f:
+        f.write(string)
+
+
+class OutboxTest(unittest.TestCase):
+    """runs in a new temporary directory, in which the outbox keeps its segments"""
+
+    def setUp(self):
+        self.prev_debug_print = daemon.DEBUG_PRINT
+        daemon.DEBUG_PRINT = False
+        self.prev_directory = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.mkdir(daemon.FileManager.DIR_OUTBOX)
+
+    def tearDown(self):
+        os.chdir(self.prev_directory)
+        shutil.rmtree(self.directory)
+        daemon.DEBUG_PRINT = self.prev_debug_print
+
+    def test_segment_filenames_round_trip(self):
+        for database in ["db", "my_db", "db/with%odd chars"]:
+            filename = os.path.basename(get_segment_filename(12, database))
+            self.assertEqual(daemon.Outbox._parse_segment_filename(filename), (12, database))
+
+    def test_misnamed_segments_not_parsed(self):
+        for filename in ["12_db.lp", "x_db.lp", "000000000012.lp", "000000000012_a%2.lp"]:
+            self.assertEqual(daemon.Outbox._parse_segment_filename(filename), None)
+
+    def test_torn_line_cut_from_segment(self):
+        write_file(get_segment_filename(0, "db"), "m v=1 1\nm v=2 2\nm v=")
+        outbox = daemon.Outbox(StandInConfig())
+        self.assertEqual(read_file(get_segment_filename(0, "db")), "m v=1 1\nm v=2 2\n")
+        self.assertEqual(outbox.segments, {"db": [[0, 16]]})
+
+    def test_segment_wholly_torn_deleted(self):
+        write_file(get_segment_filename(0, "db"), "m v=1 1\n")
+        write_file(get_segment_filename(1, "db"), "m v=")
+        write_file(get_segment_filename(2, "other"), "")
+        outbox = daemon.Outbox(StandInConfig())
+        self.assertEqual(outbox.segments, {"db": [[0, 8]]})
+        self.assertEqual(sorted(os.listdir(daemon.FileManager.DIR_OUTBOX)),
+                         [os.path.basename(get_segment_filename(0, "db"))])
+
+    def test_misnamed_segment_kept_but_skipped(self):
+        misnamed = os.path.join(daemon.FileManager.DIR_OUTBOX, "notes_db.lp")
+        write_file(misnamed, "m v=1 1\n")
+        outbox = daemon.Outbox(StandInConfig())
+        self.assertEqual(outbox.segments, {})
+        self.assertEqual(read_file(misnamed), "m v=1 1\n")
+
+    def test_new_segments_numbered_after_old(self):
+        write_file(get_segment_filename(7, "db"), "m v=1 1\n")
+        outbox = daemon.Outbox(StandInConfig())
+        outbox.add("db", "m", [(1, {"Owner": "user1"})], 2)
+        outbox.save()
+        self.assertEqual([number for number, _ in outbox.segments["db"]], [7, 8])
+        self.assertEqual(read_file(get_segment_filename(8, "db")), get_line("m", 1, {"Owner": "user1"}, 2))
+
+    def test_lines_batched_into_segments(self):
+        outbox = daemon.Outbox(StandInConfig())
+        for t in range(10):
+            outbox.add("db", "m", [(t, {"Owner": "user1"})], t)
+        outbox.save()
+
+        lines = ''.join([read_file(get_segment_filename(number, "db")) for number, _ in outbox.segments["db"]])
+        self.assertEqual(lines, ''.join([get_line("m", t, {"Owner": "user1"}, t) for t in range(10)]))
+        for number, num_bytes in outbox.segments["db"]:
+            self.assertLessEqual(num_bytes, StandInConfig.write_batch_bytes)
+            self.assertEqual(os.path.getsize(get_segment_filename(number, "db")), num_bytes)
+
+    def test_oldest_segments_evicted(self):
+        outbox = daemon.Outbox(StandInConfig())
+        for t in range(200):
+            outbox.add("db%s" % (t % 2), "m", [(t, {"Owner": "user1"})], t)
+        outbox.save()
+
+        self.assertLessEqual(outbox.get_num_bytes(), StandInConfig.outbox_max_bytes)
+        numbers = sorted([number for segments in outbox.segments.values() for number, _ in segments])
+        self.assertEqual(numbers, range(numbers[0], numbers[-1] + 1))
+        self.assertEqual(sorted(os.listdir(daemon.FileManager.DIR_OUTBOX)), sorted(
+            [os.path.basename(get_segment_filename(number, database))
+             for database in outbox.segments for number, _ in outbox.segments[database]]))
+
+        # the newest lines are those kept
+        newest = get_segment_filename(outbox.segments["db1"][-1][0], "db1")
+        self.assertTrue(read_file(newest).endswith(get_line("m", 199, {"Owner": "user1"}, 199)))
+
+    def test_failed_segments_kept_for_next_run(self):
+        outbox = daemon.Outbox(StandInConfig())
+        outbox.add("db", "m", [(1, {"Owner": "user1"})], 2)
+        outbox.save()
+        outbox.push_outgoing()
+
+        outbox = daemon.Outbox(StandInConfig())
+        self.assertEqual(outbox.segments.keys(), ["db"])
+        self.assertEqual(read_file(get_segment_filename(outbox.segments["db"][0][0], "db")),
+                         get_line("m", 1, {"Owner": "user1"}, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# Purpose:      tests the error bounds and merging of the daemon's quantile and distinct count sketches
+
+import random
+import unittest
+
+import daemon
+
+
+def get_exact_quantile(vals, q):
+    """returns the value at quantile q of vals, at the rank QuantileSketch.get_quantile estimates"""
+    return sorted(vals)[int(q * (len(vals) - 1))]
+
+
+def make_quantile_sketch(vals):
+    """returns a QuantileSketch of the values"""
+    sketch = daemon.QuantileSketch()
+    for val in vals:
+        sketch.add(val)
+    return sketch
+
+
+def make_distinct_sketch(keys):
+    """returns a DistinctSketch of the keys"""
+    sketch = daemon.DistinctSketch()
+    for key in keys:
+        sketch.add(key)
+    return sketch
+
+
+class QuantileSketchTest(unittest.TestCase):
+
+    QUANTILES = [0, 0.01, 0.25, 0.5, 0.75, 0.95, 0.99, 1]
+
+    def setUp(self):
+        self.rnd = random.Random(0)
+
+    def assert_within_accuracy(self, sketch, vals):
+        """asserts every quantile the sketch estimates is within its relative accuracy of the exact quantile"""
+        for q in QuantileSketchTest.QUANTILES:
+            exact = get_exact_quantile(vals, q)
+            self.assertLessEqual(abs(sketch.get_quantile(q) - exact),
+                                 daemon.QuantileSketch.relative_accuracy * abs(exact) + 1e-9,
+                                 "quantile %s was %s, not near %s" % (q, sketch.get_quantile(q), exact))
+
+    def test_quantiles_within_accuracy(self):
+        vals = [self.rnd.lognormvariate(5, 2) for _ in range(20000)]
+        self.assert_within_accuracy(make_quantile_sketch(vals), vals)
+
+    def test_negative_and_zero_values_within_accuracy(self):
+        vals = [self.rnd.choice([-1, 0, 1]) * self.rnd.expovariate(0.001) for _ in range(20000)]
+        self.assert_within_accuracy(make_quantile_sketch(vals), vals)
+
+    def test_merge_equals_sketch_of_all_values(self):
+        first = [self.rnd.lognormvariate(3, 1) for _ in range(5000)]
+        second = [-self.rnd.lognormvariate(6, 1) for _ in range(3000)] + [0] * 100
+        merged = make_quantile_sketch(first)
+        merged.merge(make_quantile_sketch(second))
+
+        whole = make_quantile_sketch(first + second)
+        self.assertEqual(merged.count, whole.count)
+        self.assertEqual(merged.zero_count, whole.zero_count)
+        self.assertEqual(merged.positive_counts, whole.positive_counts)
+        self.assertEqual(merged.negative_counts, whole.negative_counts)
+        self.assert_within_accuracy(merged, first + second)
+
+    def test_merge_leaves_other_sketch_unchanged(self):
+        other = make_quantile_sketch([1, 2, 3])
+        copy = other.copy()
+        sketch = make_quantile_sketch([4, 5])
+        sketch.merge(other)
+        self.assertEqual(other.positive_counts, copy.positive_counts)
+        self.assertEqual(other.count, 3)
+        self.assertEqual(sketch.count, 5)
+
+    def test_merge_of_different_accuracy_raises(self):
+        sketch = daemon.QuantileSketch()
+        prev_accuracy = daemon.QuantileSketch.relative_accuracy
+        daemon.QuantileSketch.relative_accuracy = 0.05
+        try:
+            other = daemon.QuantileSketch()
+        finally:
+            daemon.QuantileSketch.relative_accuracy = prev_accuracy
+        self.assertRaises(RuntimeError, sketch.merge, other)
+
+    def test_collapse_bounds_buckets_and_keeps_large_values_accurate(self):
+        vals = [10 ** self.rnd.uniform(-30, 30) for _ in range(20000)]
+        sketch = make_quantile_sketch(vals)
+        self.assertLessEqual(len(sketch.positive_counts), daemon.QuantileSketch.BUCKETS_MAX)
+        self.assertEqual(sum(sketch.positive_counts.values()), len(vals))
+        # only the smallest values' buckets are combined, which the top tenth are far above
+        for q in [0.9, 0.95, 0.99, 1]:
+            exact = get_exact_quantile(vals, q)
+            self.assertLessEqual(abs(sketch.get_quantile(q) - exact),
+                                 daemon.QuantileSketch.relative_accuracy * exact)
+
+
+class DistinctSketchTest(unittest.TestCase):
+
+    # the standard error is 1.04 / sqrt(2^PRECISION), within three of which (7%) nearly every estimate falls
+    MAX_RELATIVE_ERROR = 3 * 1.04 / (daemon.DistinctSketch.NUM_REGISTERS ** 0.5)
+
+    def assert_near(self, count, exact):
+        self.assertLessEqual(abs(count - exact), DistinctSketchTest.MAX_RELATIVE_ERROR * exact,
+                             "estimated %s distinct keys, not near %s" % (count, exact))
+
+    def test_empty_counts_zero(self):
+        self.assertEqual(daemon.DistinctSketch().get_count(), 0)
+
+    def test_counts_within_error(self):
+        for num_keys in [10, 100, 1000, 10000, 100000]:
+            self.assert_near(make_distinct_sketch(["job#%s" % i for i in range(num_keys)]).get_count(), num_keys)
+
+    def test_repeated_keys_counted_once(self):
+        keys = ["owner%s" % (i % 500) for i in range(20000)]
+        self.assert_near(make_distinct_sketch(keys).get_count(), 500)
+
+    def test_unicode_and_str_keys_alike(self):
+        self.assertEqual(make_distinct_sketch([u"user1"]).registers, make_distinct_sketch(["user1"]).registers)
+
+    def test_merge_counts_overlapping_keys_once(self):
+        first = ["job#%s" % i for i in range(0, 60000)]
+        second = ["job#%s" % i for i in range(40000, 100000)]
+        merged = make_distinct_sketch(first)
+        merged.merge(make_distinct_sketch(second))
+
+        self.assertEqual(merged.registers, make_distinct_sketch(first + second).registers)
+        self.assert_near(merged.get_count(), 100000)
+
+    def test_copy_is_independent(self):
+        sketch = make_distinct_sketch(["a", "b"])
+        copy = sketch.copy()
+        copy.add("c")
+        self.assertEqual(sketch.registers, make_distinct_sketch(["a", "b"]).registers)
+        self.assertNotEqual(sketch.registers, copy.registers)
+
+
+if __name__ == "__main__":
+    unittest.main()